@@ -1,3 +1,4 @@
 import dtf.cluster
+import dtf.inference
 import dtf.modules
 import dtf.replay_buffer
@@ -1,12 +1,13 @@
-import gym
-import mujoco_py
-
 class GymEnv:
     """
     A shim to adapt to customized version of mujoco_py to
     enable tiled rendering.
     """
     def __init__(self, env_name, render_params=None):
+        # Imported here so that dtf.environment, and everything built on
+        # it such as the learner, can be imported without gym.
+        import gym
+
         self.render_params = render_params
         self._env = gym.make(env_name)
 
@@ -15,6 +16,10 @@ class GymEnv:
     def _get_viewer(self, mode):
         self.viewer = self._viewers.get(mode)
         if self.viewer is None:
+            # Deferred so that headless processes which never render
+            # do not pay for (or need a display for) the viewer import.
+            import mujoco_py
+
             if mode == "human":
                 self.viewer = mujoco_py.MjViewer(
                     self._env.sim,
@@ -1,10 +1,10 @@
 import multiprocessing as mp
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
 import numpy as np
-import glfw
 from dtf.environment import gym_shm
-import cv2
-import json
 import random
+import time
 from collections import defaultdict, deque
 
 # Ubuntu dimensions for side dock, top dock, and top bars of
@@ -15,12 +15,50 @@ WINDOW_BAR_SIZE = 28
 
 class Env:
 
-    def __init__(self, env_name, num_envs):
+    # The commands whose replies are written to shared memory
+    SHARED_MEMORY_COMMANDS = ("step", "reset", "get_obs")
+
+    def __init__(self, env_name, num_envs, shared_memory=False,
+                 envs_per_process=1, stream_offset=0):
+        """
+        env_name: the gym environment id to create in every subprocess
+        num_envs: the number of environments to run
+        stream_offset: step() tags every transition with the stream id
+                       stream_offset + env index under "stream", so a
+                       replay fed by many Envs can tell which ones are
+                       consecutive. Give every Env its own range, e.g.
+                       worker index * num_envs.
+        envs_per_process: the number of environments owned by each
+                          subprocess. Every subprocess steps its slice of
+                          environments in a loop and replies with one
+                          stacked chunk, so this cuts the number of
+                          processes and pipe round trips by the same
+                          factor.
+        shared_memory: if set, the subprocesses write the entries of
+                       storage_spec directly into preallocated shared
+                       memory laid out as [num_envs, ...] arrays and only
+                       small control messages go through the pipes. The
+                       arrays returned by step(), reset() and get_obs()
+                       are then views into that memory which are
+                       overwritten by the next call.
+        """
         self.num_envs = num_envs
         self.env_name = env_name
+        self.shared_memory = shared_memory
+        self.envs_per_process = envs_per_process
+        self.stream_offset = stream_offset
+
+        # The contiguous range of env indices owned by each subprocess
+        self._slices = [
+            range(start, min(start + envs_per_process, num_envs))
+            for start in range(0, num_envs, envs_per_process)]
+        self.num_procs = len(self._slices)
 
         self._procs = []
         self._pipes = []
+        self._shm = {}
+        self._shm_arrays = {}
+        self._waiting = set()
 
         self._setup_envs(env_name, num_envs)
 
@@ -28,7 +66,10 @@ class Env:
 
         self.proto_env = gym_shm.make(name)
 
-        for i in range(num):
+        if self.shared_memory:
+            self._setup_shared_memory()
+
+        for i in range(self.num_procs):
             pipe = mp.Pipe()
             proc = mp.Process(target=self._env_worker,
                               args=(pipe, i))
@@ -38,32 +79,89 @@ class Env:
             self._procs[-1].daemon = True
             self._procs[-1].start()
 
+    def _setup_shared_memory(self):
+        for k, (shape, dtype) in self.storage_spec.items():
+            nbytes = int(np.prod((self.num_envs, *shape))) * \
+                np.dtype(dtype).itemsize
+            self._shm[k] = shared_memory.SharedMemory(
+                create=True, size=max(nbytes, 1))
+        self._attach_shared_memory()
+
+    def _attach_shared_memory(self):
+        # The SharedMemory handles pickle by name, so this also works
+        # for subprocesses which are not forked from the parent.
+        for k, (shape, dtype) in self.storage_spec.items():
+            self._shm_arrays[k] = np.ndarray(
+                (self.num_envs, *shape), dtype=dtype,
+                buffer=self._shm[k].buf)
+
+    def _write_shared_memory(self, env_inds, mode, data):
+        # Move every entry that has a shared memory slot out of the
+        # message, leaving a None marker so the parent knows which
+        # arrays have been updated. Only transitions are laid out like
+        # storage_spec, e.g. "reward" replies hold whole episodes.
+        if data is None or not self._shm_arrays or \
+           mode not in self.SHARED_MEMORY_COMMANDS:
+            return data
+        for k in data:
+            if k in self._shm_arrays:
+                self._shm_arrays[k][env_inds.start:env_inds.stop] = data[k]
+                data[k] = None
+        return data
+
     def _send(self, cmd, data=None, only_one=False):
+        assert not self._waiting, \
+            "Collect outstanding steps with step_wait() first"
         if data is None:
             data = [None] * self.num_envs
         if isinstance(data, str):
             data = [data] * self.num_envs
 
-        for i in range(self.num_envs):
-            self._pipes[i].send((cmd, data[i]))
-            if only_one:
-                break
+        if only_one:
+            # Only the first environment of the first subprocess acts
+            data = [data[0]] + [None] * (len(self._slices[0]) - 1)
+            self._pipes[0].send((cmd, data))
+            return
+
+        for i, env_inds in enumerate(self._slices):
+            self._pipes[i].send(
+                (cmd, data[env_inds.start:env_inds.stop]))
+
+    def _env_inds(self, proc_inds):
+        return [ind for i in proc_inds for ind in self._slices[i]]
+
+    def _recv(self, only_one=False, indices=None):
+        if indices is None:
+            indices = list(range(1 if only_one else self.num_procs))
 
-    def _recv(self, only_one=False):
         ret_data = defaultdict(lambda: [])
-        bound = 1 if only_one else self.num_envs
-        for i in range(bound):
+        shm_keys = set()
+        for i in indices:
             data = self._pipes[i].recv()
             if data is None:
                 continue
             for k, v in data.items():
+                if k in self._shm_arrays and v is None:
+                    shm_keys.add(k)
+                    continue
                 ret_data[k].append(v)
 
         for k in ret_data:
-            ret_data[k] = np.stack(ret_data[k], axis=0)
+            ret_data[k] = np.concatenate(ret_data[k], axis=0)
+
+        env_inds = self._env_inds(indices)
+        for k in shm_keys:
+            if len(env_inds) == self.num_envs:
+                ret_data[k] = self._shm_arrays[k]
+            else:
+                ret_data[k] = self._shm_arrays[k][env_inds]
         return ret_data
 
     def _get_position_from_i(self, ind):
+        # Only needed to tile windows for render(mode="human"), so glfw
+        # is imported here to keep headless subprocesses free of it.
+        import glfw
+
         glfw.init()
         resolution, _, _ = glfw.get_video_mode(glfw.get_primary_monitor())
 
@@ -84,67 +182,98 @@ class Env:
             "y": row * sim_height + row*WINDOW_BAR_SIZE + TOP_BAR_SIZE,
         }
 
-    def _env_worker(self, pipe, ind):
+    def _env_worker(self, pipe, proc_ind):
         pipe[0].close()
         pipe = pipe[1]
 
-        render_params = self._get_position_from_i(ind)
+        env_inds = self._slices[proc_ind]
+
+        if self._shm:
+            self._attach_shared_memory()
 
-        np.random.seed(ind*100)
-        random.seed(ind*100)
+        np.random.seed(env_inds[0]*100)
+        random.seed(env_inds[0]*100)
 
-        env = gym_shm.make(self.env_name,
-                           render_params=render_params)
-        env.seed(ind*100)
+        envs = []
+        for ind in env_inds:
+            envs.append(gym_shm.make(self.env_name))
+            envs[-1].seed(ind*100)
 
-        rewards_buff = deque(maxlen=1)
-        rewards_list = []
-        done = False
-        obs = None
+        rewards_buff = [deque(maxlen=1) for _ in envs]
+        rewards_list = [[] for _ in envs]
+        obs = [None] * len(envs)
         while True:
             mode, data = pipe.recv()
-            return_data = None
             if mode == "close":
-                env.close()
+                for env in envs:
+                    env.close()
                 return
             if mode == "seed":
-                np.random.seed(data)
-                random.seed(data)
-                env.seed(data)
-            elif mode == "render":
-                res  = env.render(mode=data)
-                if data == "rgb_array":
-                    return_data = {"image": res}
-            elif mode == "step":
-                next_obs, rew, done, info = env.step(data)
-                rewards_list.append(rew)
-
-                return_data = {
-                    "observation": obs.copy()
-                    "next_observation": next_obs.copy(),
-                    "reward": rew,
-                    "done": done,
-                    "info": info
-                }
-                obs = next_obs
-                if done:
-                    obs = env.reset()
-                    rewards_buff.append(rewards_list)
-                    rewards_list = []
-            elif mode == "get_obs":
-                if obs is None:
-                    obs = env.reset()
-                return_data = {"observation": obs}
-            elif mode == "reset":
-                obs = env.reset()
-                return_data = {"observation": obs}
-
-                rewards_buff.append(rewards_list)
-                rewards_list = []
-            elif mode == "reward":
-                return_data = {"reward": list(rewards_buff)}
-
-            pipe.send(return_data)
+                np.random.seed(data[0])
+                random.seed(data[0])
+
+            chunk = []
+            for i, env in enumerate(envs):
+                return_data = None
+                if mode == "seed":
+                    env.seed(data[i])
+                elif mode == "render":
+                    if data[i] is None:
+                        continue
+                    if data[i] == "human" and env.render_params is None:
+                        env.render_params = self._get_position_from_i(
+                            env_inds[i])
+                    res  = env.render(mode=data[i])
+                    if data[i] == "rgb_array":
+                        return_data = {"image": res}
+                elif mode == "step":
+                    next_obs, rew, done, info = env.step(data[i])
+                    rewards_list[i].append(rew)
+
+                    return_data = {
+                        "observation": obs[i].copy(),
+                        "next_observation": next_obs.copy(),
+                        "reward": rew,
+                        "done": done,
+                        "stream": self.stream_offset + env_inds[i],
+                        "info": info
+                    }
+                    obs[i] = next_obs
+                    if done:
+                        obs[i] = env.reset()
+                        rewards_buff[i].append(rewards_list[i])
+                        rewards_list[i] = []
+                elif mode == "get_obs":
+                    if obs[i] is None:
+                        obs[i] = env.reset()
+                    return_data = {"observation": obs[i]}
+                elif mode == "reset":
+                    obs[i] = env.reset()
+                    return_data = {"observation": obs[i]}
+
+                    rewards_buff[i].append(rewards_list[i])
+                    rewards_list[i] = []
+                elif mode == "reward":
+                    # The rewards of the last finished episode
+                    episode = rewards_buff[i][-1] if rewards_buff[i] else []
+                    return_data = {"reward": np.array(episode, np.float32)}
+
+                if return_data is not None:
+                    chunk.append(return_data)
+
+            if chunk and mode == "reward":
+                # Episodes differ in length, so keep one array per env
+                rewards = np.empty(len(chunk), dtype=object)
+                for i, d in enumerate(chunk):
+                    rewards[i] = d["reward"]
+                chunk = {"reward": rewards}
+            elif chunk:
+                chunk = {k: np.stack([d[k] for d in chunk], axis=0)
+                         for k in chunk[0]}
+                chunk = self._write_shared_memory(env_inds, mode, chunk)
+            else:
+                chunk = None
+            pipe.send(chunk)
 
     @property
     def action_space(self):
@@ -152,35 +281,132 @@ class Env:
 
     @property
     def observation_space(self):
-        return self.proto_env.abservation_space
+        return self.proto_env.observation_space
+
+    @property
+    def storage_spec(self):
+        obs_shape = tuple(self.observation_space.shape)
+        # Keep integer observations (e.g. uint8 pixels) compact, but
+        # store float observations at single precision.
+        obs_dtype = np.dtype(self.observation_space.dtype)
+        if np.issubdtype(obs_dtype, np.floating):
+            obs_dtype = np.dtype(np.float32)
+        return {
+            "observation": (obs_shape, obs_dtype),
+            "next_observation": (obs_shape, obs_dtype),
+            "reward": ((), np.float32),
+            "done": ((), np.bool_),
+            "stream": ((), np.int64),
+        }
 
     def reset(self):
         self._send("reset")
         return self._recv()
 
     def get_obs(self):
-        self._send("obs")
+        self._send("get_obs")
         return self._recv()
 
     def avg_return(self):
+        """
+        The return of the last finished episode of every env, averaged.
+        Envs which have not finished one yet count as 0.
+        """
         self._send("reward")
         data = self._recv()
-        return np.mean(np.sum(data, axis=-1))
+        return np.mean([np.sum(r) for r in data["reward"]])
 
     def max_step_reward(self, is_eval=False):
         self._send("reward")
         data = self._recv()
-        return np.max(data)
+        return np.max(np.concatenate(list(data["reward"])))
 
     def step(self, action):
         self._send("step", action)
         return self._recv()
 
+    def step_async(self, action, indices=None):
+        """
+        Send actions to the environments in indices (all of them by
+        default) without waiting for the results. action is ordered
+        the same way as indices. Results are collected with step_wait().
+        """
+        if indices is None:
+            indices = range(self.num_envs)
+        position = {ind: i for i, ind in enumerate(indices)}
+
+        for proc_ind, env_inds in enumerate(self._slices):
+            chunk = [position[ind] for ind in env_inds if ind in position]
+            if not chunk:
+                continue
+            assert len(chunk) == len(env_inds), \
+                "All envs of a subprocess have to be stepped together"
+            assert proc_ind not in self._waiting, \
+                f"Envs {list(env_inds)} are already stepping"
+            self._pipes[proc_ind].send(
+                ("step", [action[i] for i in chunk]))
+            self._waiting.add(proc_ind)
+
+    def step_wait(self, timeout=None, min_ready=None):
+        """
+        Collect the results of environments stepped with step_async().
+
+        timeout: the maximum number of seconds to block for, None blocks
+                 until min_ready environments have finished.
+        min_ready: the number of finished environments to wait for,
+                   defaults to every outstanding environment. Envs
+                   finish together with the rest of their subprocess.
+
+        Returns the stacked results of every environment which has
+        finished so far, along with their env indices under "indices".
+        Environments which are still stepping stay outstanding and are
+        returned by a later call.
+        """
+        num_waiting = len(self._env_inds(self._waiting))
+        if min_ready is None:
+            min_ready = num_waiting
+        min_ready = min(min_ready, num_waiting)
+
+        pending = {self._pipes[i]: i for i in self._waiting}
+        deadline = None if timeout is None else time.time() + timeout
+        ready = []
+        num_ready = 0
+        while pending:
+            if num_ready >= min_ready:
+                # Pick up anything else which is already finished
+                remaining = 0
+            elif deadline is None:
+                remaining = None
+            else:
+                remaining = max(deadline - time.time(), 0)
+
+            finished = wait(list(pending), timeout=remaining)
+            if not finished:
+                break
+            for pipe in finished:
+                ready.append(pending.pop(pipe))
+                num_ready += len(self._slices[ready[-1]])
+
+        ready = sorted(ready)
+        ret_data = self._recv(indices=ready)
+        self._waiting.difference_update(ready)
+        ret_data["indices"] = np.array(
+            self._env_inds(ready), dtype=np.int64)
+        return ret_data
+
     def render(self, mode='human', only_one=False):
         self._send("render", mode, only_one=only_one)
         return self._recv(only_one=only_one)
 
     def close(self):
+        if self._waiting:
+            self.step_wait()
         self._send("close")
-        for i in range(self.num_envs):
-            self._procs[i].join()
+        for proc in self._procs:
+            proc.join()
+
+        self._shm_arrays = {}
+        for shm in self._shm.values():
+            shm.close()
+            shm.unlink()
+        self._shm = {}
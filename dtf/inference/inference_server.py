@@ -0,0 +1,141 @@
+import tensorflow as tf
+import time
+
+from dtf.modules import DistributedModule, QueueModule
+
+class InferenceServer(DistributedModule):
+    """
+    Runs the policy for many workers at once. Workers send their
+    observations to a server task, which gathers them into one batch,
+    runs a single forward pass and sends every worker its actions
+    back. Only the server tasks receive weights from the learner.
+
+    The same object is built on every task: workers call it like a
+    model, the learner uses push() to publish weights to the servers
+    and the server tasks call run().
+    """
+    def __init__(self,
+                 # model arguments
+                 model,
+                 observation_shape,
+                 action_shape,
+                 num_envs,
+                 # batching arguments
+                 max_batch_size,
+                 max_latency,
+                 # distributed arguments
+                 worker_name, learner_name,
+                 server_name, task_name,
+                 task_index, cluster):
+        """
+        model: the DistributedModel used to compute actions
+        observation_shape: the shape of a single observation
+        action_shape: the shape of a single action
+        num_envs: the number of environments stepped by every worker,
+                  each request carries one observation per environment
+        max_batch_size: the number of observations to gather before
+                        running the model
+        max_latency: the number of seconds to wait for a batch to fill
+                     up after the first request arrives
+        """
+        self._num_envs = num_envs
+        self._is_worker = task_name == worker_name
+        self._max_batch_size = max_batch_size
+        self._max_latency = max_latency
+
+        # learner -> server weights
+        super().__init__(model,
+                         cluster=cluster,
+                         data_source=learner_name,
+                         module_name=server_name,
+                         task=task_name,
+                         index=task_index,
+                         push_to_all=True,
+                         versioned=True)
+
+        # worker -> server observations
+        self._requests = QueueModule(
+            {"observation": observation_shape},
+            cluster=cluster,
+            data_source=worker_name,
+            module_name=server_name,
+            task=task_name,
+            index=task_index,
+            inbound_size=num_envs)
+
+        # server -> worker actions
+        self._replies = QueueModule(
+            {"action": action_shape},
+            cluster=cluster,
+            data_source=server_name,
+            module_name=worker_name,
+            task=task_name,
+            index=task_index,
+            inbound_size=num_envs)
+
+        # Expose every queue this module talks over, not just the
+        # weight queues, so callers can tell when traffic has drained.
+        self._update_queues.update(self._requests._update_queues)
+        self._update_queues.update(self._replies._update_queues)
+
+    def __call__(self, x, explore=False):
+        # Only workers go through a server, the servers and the learner
+        # hold the model themselves.
+        if not self._is_worker:
+            return self._base_model(x, explore=explore)
+
+        # Each worker always talks to the same server so it knows
+        # which queue the reply arrives on.
+        server_ind = self._index % self._num_module
+        self._requests.push({"observation": x["observation"]},
+                            force_ind=server_ind)
+        return self._replies.pull_from(server_ind)["action"]
+
+    def pull(self, wait=True, return_data=False, timeout=None):
+        # Workers never hold the weights, only the servers do
+        if not self._is_module:
+            return None
+        return super().pull(wait=wait, return_data=return_data,
+                            timeout=timeout)
+
+    def maybe_pull(self):
+        return self.pull(wait=False)
+
+    def _gather(self):
+        requests = {}
+        deadline = None
+        while len(requests) * self._num_envs < self._max_batch_size:
+            ready = self._requests.pull_ready(skip=requests)
+            requests.update(ready)
+            if requests and deadline is None:
+                deadline = time.time() + self._max_latency
+            if deadline is not None and time.time() >= deadline:
+                break
+            if not ready:
+                time.sleep(0.001)
+        return requests
+
+    def serve(self):
+        """
+        Gather one batch of requests, run the model on it and send the
+        actions back to the workers which asked for them.
+        """
+        requests = self._gather()
+        sources = list(requests.keys())
+        observations = tf.concat(
+            [requests[s]["observation"] for s in sources], axis=0)
+
+        actions = self._base_model(
+            {"observation": observations}, explore=True)
+        actions = tf.split(actions, len(sources), axis=0)
+        for source_ind, action in zip(sources, actions):
+            self._replies.push({"action": action},
+                               force_ind=source_ind)
+        print(f"Served a batch of {observations.shape[0]}")
+
+    def run(self):
+        # Wait for the first set of weights from the learner
+        self.pull()
+        while True:
+            self.maybe_pull()
+            self.serve()
@@ -1 +1,2 @@
 from .learner import Learner
+from .prefetcher import Prefetcher
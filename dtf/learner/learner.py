@@ -1,14 +1,17 @@
 import tensorflow as tf
 
 from dtf.modules import DistributedModel, Model, DistributedModule
+from dtf.modules import ParameterServerModule
 from dtf.replay_buffer import get_replay_buffer, DistributedRelayBuffer
 from dtf.environment import Env
+from dtf.inference import InferenceServer
+from dtf.learner.prefetcher import Prefetcher
 
 class Learner:
 
     def __init__(self, model_cls, worker_spec, learner_spec,
                  cluster, task, task_index, replay_buffer_spec,
-                 distributed=False):
+                 distributed=False, inference_spec=None):
 
         self._model_cls = model_cls
         self._cluster = cluster
@@ -18,6 +21,10 @@ class Learner:
         self._learner_spec = learner_spec
         self._worker_spec = worker_spec
         self._replay_buffer_spec = replay_buffer_spec
+        self._inference_spec = inference_spec
+        # Where the batch being trained on was sampled from, the
+        # prefetcher has usually pulled more batches since.
+        self._batch_origin = None
 
         self._setup()
 
@@ -29,13 +36,46 @@ class Learner:
             env.storage_spec
         )
 
-        if self._distributed:
-            self._model = DistributedModule(
-                self._model, data_source="learner",
-                data_sink=None, cluster=self._cluster,
-                module_name="worker", task=self._task,
-                index=self._task_index
+        if self._distributed and self._inference_spec:
+            # Weights go to the inference servers instead of the workers
+            self._model = InferenceServer(
+                self._model,
+                env.observation_space.shape,
+                env.action_space.shape,
+                self._worker_spec["num_envs"],
+                self._inference_spec["max_batch_size"],
+                self._inference_spec["max_latency"],
+                worker_name="worker",
+                learner_name="learner",
+                server_name="inference",
+                task_name=self._task,
+                task_index=self._task_index,
+                cluster=self._cluster,
             )
+        elif self._distributed:
+            if self._learner_spec.get("parameter_server"):
+                # The weights are sharded over a ps job instead of being
+                # queued to every worker
+                self._model = ParameterServerModule(
+                    self._model,
+                    ps_name=self._learner_spec["parameter_server"],
+                    data_source="learner", cluster=self._cluster,
+                    module_name="worker", task=self._task,
+                    index=self._task_index,
+                )
+            else:
+                self._model = DistributedModule(
+                    self._model, data_source="learner",
+                    data_sink=None, cluster=self._cluster,
+                    module_name="worker", task=self._task,
+                    index=self._task_index, push_to_all=True,
+                    versioned=True,
+                    update_codec=self._learner_spec.get("update_codec"),
+                    keyframe_interval=self._learner_spec.get(
+                        "keyframe_interval", 10),
+                    fanout=self._learner_spec.get("fanout"),
+                    compile_push=self._learner_spec.get("compile", False),
+                )
             self._replay_buffer = DistributedRelayBuffer(
                 self._replay_buffer_spec["type"],
                 env.storage_spec,
@@ -47,26 +87,160 @@ class Learner:
                 task_name=self._task,
                 task_index=self._task_index,
                 cluster=self._cluster,
+                replay_buffer_kwargs=self._replay_buffer_spec.get(
+                    "kwargs"),
+                # The queue layout has to match on every task
+                inbound_size=self._replay_buffer_spec.get(
+                    "inbound_size", 0),
+                inbound_capacity=self._replay_buffer_spec.get(
+                    "inbound_capacity", 10),
+                outbound_capacity=self._replay_buffer_spec.get(
+                    "outbound_capacity", 10),
+                max_queue_bytes=self._replay_buffer_spec.get(
+                    "max_queue_bytes"),
+                shard_batches=self._replay_buffer_spec.get(
+                    "shard_batches", 1),
+                # Checked against the replay buffer type on every task
+                routing=self._replay_buffer_spec.get("routing", "random"),
+                staging_capacity=self._replay_buffer_spec.get(
+                    "staging_capacity", 0),
+                staging_overflow=self._replay_buffer_spec.get(
+                    "staging_overflow", "drop_oldest"),
             )
         else:
             self._replay_buffer = get_replay_buffer(
                 self._replay_buffer_spec["type"])(
                     env.storage_spec,
-                    self._replay_buffer_spec["capacity"]
+                    self._replay_buffer_spec["capacity"],
+                    **self._replay_buffer_spec.get("kwargs", {})
                 )
 
         env.close()
         del env
 
-    def train_on_batch(self):
+        # learner_spec["train_steps"] batches are trained on between two
+        # pushes of the weights.
+        self._train_steps = self._learner_spec.get("train_steps", 1)
+        self._compiled = self._learner_spec.get("compile", False)
+        self._train_step = self.train_on_batch
+        self._fused_step = None
+        if self._compiled:
+            self._compile(self._learner_spec.get("xla", False))
+
+    def _batch_signature(self):
+        """
+        A TensorSpec for every entry of a replay batch, from the
+        storage_spec and what the replay buffer adds when sampling. The
+        batch dimension is left open so one trace serves every batch.
+        """
+        if self._distributed:
+            spec = {v.name: (v.shape, v.dtype)
+                    for v in self._replay_buffer.outbound_variables}
+        else:
+            replay_buffer = self._replay_buffer
+            spec = {k: (shape, replay_buffer.storage_dtypes[k])
+                    for k, shape in replay_buffer.storage_shapes.items()}
+            spec.update(replay_buffer.sample_spec)
+        return {k: tf.TensorSpec([None, *shape], tf.as_dtype(dtype))
+                for k, (shape, dtype) in spec.items()}
+
+    def _compile(self, jit_compile):
+        signature = self._batch_signature()
+        self._train_step = tf.function(
+            self.train_on_batch, input_signature=[signature],
+            jit_compile=jit_compile)
+        if self._train_steps > 1:
+            # All the steps between two pushes run as a single call on
+            # the batches stacked along a new leading dimension.
+            stacked = {k: tf.TensorSpec([self._train_steps, *v.shape],
+                                        v.dtype)
+                       for k, v in signature.items()}
+            self._fused_step = tf.function(
+                self._train_fused, input_signature=[stacked],
+                jit_compile=jit_compile)
+
+    def _train_fused(self, batches):
+        # Unrolled, train_steps is small and the outputs of
+        # train_on_batch can be anything or None.
+        return [self.train_on_batch({k: v[i] for k, v in batches.items()})
+                for i in range(self._train_steps)]
+
+    def train_on_batch(self, batch):
+        """
+        Take one training step on a batch sampled from the replay.
+
+        With learner_spec["compile"] this is traced by tf.function, so
+        it has to be written in TensorFlow ops. It can then not call
+        update_priorities() but should return the new priorities of the
+        batch instead, which the learner sends on.
+        """
         raise NotImplementedError
 
+    def update_priorities(self, indices, priorities):
+        """
+        Send new priorities (e.g. TD errors) for a batch sampled from a
+        prioritized replay buffer. indices is the "indices" entry of
+        that batch. Meant to be called from train_on_batch.
+        """
+        if self._distributed:
+            self._replay_buffer.update_priorities(
+                indices, priorities, origin=self._batch_origin)
+        else:
+            self._replay_buffer.update_priorities(indices, priorities)
+
+    def _pull_batch(self):
+        replay_data = self._replay_buffer.pull(return_data=True)
+        if replay_data is None or not self._distributed:
+            return replay_data
+        return replay_data, self._replay_buffer.batch_origin()
+
+    def _next_batch(self, prefetcher):
+        """
+        The next batch and the batch_origin() of the replay it came
+        from.
+        """
+        while True:
+            if prefetcher is not None:
+                replay_data = prefetcher.get()
+            else:
+                replay_data = self._pull_batch()
+            if replay_data is not None:
+                break
+        if self._distributed:
+            return replay_data
+        return replay_data, None
+
+    def _train(self, batches):
+        if self._fused_step is not None:
+            outputs = self._fused_step({
+                k: tf.stack([batch[k] for batch, _ in batches])
+                for k in batches[0][0]})
+        else:
+            outputs = []
+            for batch, origin in batches:
+                self._batch_origin = origin
+                outputs.append(self._train_step(batch))
+
+        if not self._compiled:
+            return
+        for (batch, origin), priorities in zip(batches, outputs):
+            if priorities is not None and "indices" in batch:
+                self._batch_origin = origin
+                self.update_priorities(batch["indices"], priorities)
+
     def run(self):
+        # learner_spec["prefetch"] batches are pulled from the replay
+        # and copied to the learner while it trains, 0 pulls serially.
+        depth = self._learner_spec.get("prefetch", 2)
+        prefetcher = None
+        if depth > 0:
+            prefetcher = Prefetcher(
+                self._pull_batch, depth,
+                device=self._learner_spec.get("device"))
 
         self._model.push()
         while True:
-            replay_data = self._replay_buffer.pull(return_data=True)
-
-            self.train_on_batch(replay_data)
+            self._train([self._next_batch(prefetcher)
+                         for _ in range(self._train_steps)])
 
             self._model.push()
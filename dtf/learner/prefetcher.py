@@ -0,0 +1,76 @@
+import tensorflow as tf
+import threading
+import queue
+
+class Prefetcher:
+    """
+    Pulls batches ahead of the learner on a background thread, so the
+    next batches are dequeued and copied to the learner device while
+    it trains on the current one.
+    """
+    def __init__(self, fetch, depth=2, device=None):
+        """
+        fetch: called for every batch, returns the batch, any nest of
+               tensors, or None if nothing was available yet
+        depth: the most batches kept ready
+        device: the device every tensor of a batch is copied to. By
+                default the one eager ops run on, where the learner
+                model lives.
+        """
+        assert depth > 0
+        self._fetch = fetch
+        self._device = device
+        self._batches = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._error = None
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _copy(self, value):
+        if not isinstance(value, tf.Tensor):
+            return value
+        # identity runs on the target device, so a tensor dequeued
+        # from a remote queue is copied over here, not by the learner.
+        if self._device is None:
+            return tf.identity(value)
+        with tf.device(self._device):
+            return tf.identity(value)
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                batch = self._fetch()
+                if batch is None:
+                    continue
+                batch = tf.nest.map_structure(self._copy, batch)
+                while not self._stop.is_set():
+                    try:
+                        self._batches.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+        except Exception as e:
+            # Surfaced by get() since this thread has no caller
+            self._error = e
+
+    def get(self, timeout=None):
+        """
+        The next batch, or None if none was ready within timeout
+        seconds. Raises any error hit while fetching.
+        """
+        while True:
+            if self._error is not None:
+                raise self._error
+            try:
+                return self._batches.get(
+                    timeout=0.1 if timeout is None else min(timeout, 0.1))
+            except queue.Empty:
+                if timeout is not None:
+                    timeout -= 0.1
+                    if timeout <= 0:
+                        return None
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
@@ -1,3 +1,6 @@
 from .distributed_module import DistributedModel
 from .distributed_module import DistributedModule
 from .distributed_module import Model
+from .distributed_module import Variable
+from .distributed_module import QueueModule
+from .parameter_server import ParameterServerModule
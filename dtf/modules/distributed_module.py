@@ -1,7 +1,17 @@
 import tensorflow as tf
+import threading
 import time
+import zlib
 import numpy as np
 
+from collections import deque, namedtuple
+
+from . import update_codec as codecs
+
+# A lightweight description of a tensor carried by a queue, for modules
+# whose distributed_variables are not tf.Variables.
+Variable = namedtuple("Variable", ("shape", "name", "dtype"))
+
 class Model(tf.Module):
     """
     A base model class intended to serve a shim allowing both
@@ -23,11 +33,9 @@ class Model(tf.Module):
 
 class DistributedModel(Model):
 
-    def __init__(self, observation_space,
-                 action_space, update_method="assign"):
-        super().__init__()
-        self.observation_space = observation_space
-        self.action_space = action_space
+    def __init__(self, observation_space=None,
+                 action_space=None, update_method="assign"):
+        super().__init__(observation_space, action_space)
         self.update_method = update_method
 
     def maybe_pull(self):
@@ -69,6 +77,20 @@ class DistributedModule:
     as input (data_source) data output by another models, process
     it, and then optionally output to another module (data_sink).
     """
+    # The first backoff in seconds between queue checks while waiting
+    # for an update, doubled up to max_poll_interval. A blocking dequeue
+    # on a remote queue stalls the server hosting it, so waits poll the
+    # queue sizes instead.
+    min_poll_interval = 0.001
+
+    ROUTING = ("random", "round_robin", "least_loaded", "hash")
+    STAGING_OVERFLOW = ("drop_oldest", "drop_newest", "block")
+
+    # The queue entry holding the version of a versioned push
+    VERSION_KEY = "version"
+    # The queue entry holding the keyframe version a delta is against
+    BASE_KEY = "base_version"
+
     def __init__(self, base_model,
                  data_source=None,
                  data_sink=None,
@@ -78,7 +100,19 @@ class DistributedModule:
                  index=None,
                  push_to_all=False,
                  inbound_size=0,
-                 outbound_size=0):
+                 outbound_size=0,
+                 inbound_capacity=10,
+                 outbound_capacity=10,
+                 max_queue_bytes=None,
+                 versioned=False,
+                 update_codec=None,
+                 keyframe_interval=10,
+                 fanout=None,
+                 routing="random",
+                 staging_capacity=0,
+                 staging_overflow="drop_oldest",
+                 compile_push=False,
+                 max_poll_interval=0.1):
         """
         base_model: the DistributedModel instance that we are wrapping
                     with communication
@@ -98,17 +132,102 @@ class DistributedModule:
                      or if we are an instance of module_name with multiple
                      data_sinks, a call to push() will push data to all
                      destinations.
+        inbound_size: when above 0 every element sent by data_source is
+                      a chunk of inbound_size rows, so one enqueue
+                      carries that many rows
+        outbound_size: the same for elements sent to data_sink
+        inbound_capacity: the number of elements every queue from
+                          data_source holds before push() blocks
+        outbound_capacity: the same for the queues to data_sink
+        max_queue_bytes: an optional bound on the memory a full queue
+                         takes, lowering its capacity where needed
+        versioned: tag every push with an increasing version so that
+                   pull() skips straight to the newest element queued
+                   by a source and never applies one older than what
+                   it already holds. Meant for weight broadcasts.
+        update_codec: send pushed variables as deltas against the last
+                      keyframe, quantized to "float16" or "int8".
+                      Implies versioned. Only for pushes of the module
+                      variables, not of data.
+        keyframe_interval: with an update_codec, every
+                           keyframe_interval-th push sends the exact
+                           variables as the new keyframe instead.
+        fanout: relay push_to_all broadcasts from data_source through a
+                fanout-ary tree of the module_name tasks. data_source
+                only pushes to the first fanout tasks and every task
+                forwards what it pulls to its children, so each push
+                leaves data_source fanout times instead of once per
+                task. A subtree gets an update when its root pulls.
+        routing: how push() picks the destination when not pushing to
+                 all of them and no force_ind is given, one of
+                 "random": uniformly at random
+                 "round_robin": cycle through the destinations
+                 "least_loaded": the destination whose queue from us
+                                 holds the fewest elements
+                 "hash": always the same destination for a given task
+        staging_capacity: the number of elements push_async() holds
+                          locally while a background thread sends them
+        staging_overflow: what push_async() does when staging_capacity
+                          elements are already waiting, one of
+                          "drop_oldest": drop the oldest staged element
+                          "drop_newest": drop the new element
+                          "block": wait for room like push()
+        compile_push: push the module variables with one tf.function
+                      call which reads them and enqueues them to every
+                      destination, rather than op by op. Only applies
+                      without an update_codec.
+        max_poll_interval: the most seconds between two checks of the
+                           queues while waiting for an update. Every
+                           check is a size() call per queue to the task
+                           hosting it, so a lower value picks updates up
+                           sooner at the cost of more RPCs.
         """
         self._base_model = base_model
         self.cluster = cluster
         self._inbound_size = inbound_size
         self._outbound_size = outbound_size
+        self._inbound_capacity = inbound_capacity
+        self._outbound_capacity = outbound_capacity
+        self._max_queue_bytes = max_queue_bytes
 
         self._data_source = data_source
         self._data_sink = data_sink
         self._module_name = module_name
         self._index = index
         self._push_to_all = push_to_all
+        self._update_codec = update_codec
+        self._keyframe_interval = keyframe_interval
+        self._versioned = versioned or update_codec is not None
+        self._fanout = fanout
+        self._routing = routing
+        assert routing in self.ROUTING, f"Unknown routing {routing}"
+        # The destination round_robin routing pushes to next
+        self._next_sink = index or 0
+
+        assert staging_overflow in self.STAGING_OVERFLOW, \
+            f"Unknown staging_overflow {staging_overflow}"
+        self._staging_capacity = staging_capacity
+        self._staging_overflow = staging_overflow
+        self._compile_push = compile_push
+        self.max_poll_interval = max_poll_interval
+        # The compiled pushes of the module variables, by the queues
+        # they enqueue to
+        self._publish_fns = {}
+        self._staged = deque()
+        # The number of elements the sender took from self._staged and
+        # is still enqueueing
+        self._sending = 0
+        self._staging_cond = threading.Condition()
+        self._sender = None
+        self._sender_error = None
+        # The number of staged elements dropped on overflow
+        self.dropped = 0
+        # The version last pushed, or last pulled, by this module
+        self.version = 0
+        # The last keyframe pushed and the last keyframe pulled, each
+        # as (version, {name: value})
+        self._push_keyframe = (0, None)
+        self._pull_keyframe = (0, None)
 
         self._is_source = task == self._data_source
         self._is_sink = task == self._data_sink
@@ -117,8 +236,14 @@ class DistributedModule:
         self._num_module = cluster.count(module_name)
         self._num_sources = 0 if not data_source else cluster.count(data_source)
         self._num_sinks = 0 if not data_sink else cluster.count(data_sink)
+        assert fanout is None or (push_to_all and fanout > 0), \
+            "A relay tree is only used for push_to_all broadcasts"
 
         self._update_queues = {}
+        # The capacity each queue in self._update_queues was built with
+        self._capacities = {}
+        # The source index of the last element returned by pull()
+        self.last_source = None
 
         self._make_queues()
 
@@ -130,6 +255,14 @@ class DistributedModule:
     def distributed_variables(self):
         return self.variables
 
+    @property
+    def outbound_variables(self):
+        """
+        The tensors sent to data_sink, by default the same as the
+        tensors received from data_source.
+        """
+        return self.distributed_variables
+
     def __call__(self, x):
         return self._base_model(x)
 
@@ -141,6 +274,10 @@ class DistributedModule:
         shapes = [v.shape for v in variables]
         names =  [v.name for v in variables]
 
+        outbound_variables = self.outbound_variables
+        outbound_dtypes = [v.dtype for v in outbound_variables]
+        outbound_names = [v.name for v in outbound_variables]
+
         inbound_shapes = []
         outbound_shapes = []
         for i in range(len(shapes)):
@@ -148,11 +285,31 @@ class DistributedModule:
                 inbound_shapes.append([self._inbound_size] + shapes[i])
             else:
                 inbound_shapes.append(shapes[i])
+        for v in outbound_variables:
             if self._outbound_size > 0:
-                outbound_shapes.append([self._outbound_size] + shapes[i])
+                outbound_shapes.append([self._outbound_size] + v.shape)
             else:
-                outbound_shapes.append(shapes[i])
-
+                outbound_shapes.append(v.shape)
+
+        if self._versioned:
+            # Every element carries the version it was pushed with
+            dtypes.append(tf.int64)
+            names.append(self.VERSION_KEY)
+            inbound_shapes.append([])
+            outbound_dtypes.append(tf.int64)
+            outbound_names.append(self.VERSION_KEY)
+            outbound_shapes.append([])
+
+        inbound_spec = (dtypes, inbound_shapes, names)
+        outbound_spec = (outbound_dtypes, outbound_shapes, outbound_names)
+        # Exact keyframes travel on their own queues, the regular
+        # queues carry the encoded deltas.
+        inbound_keyframe_spec = outbound_keyframe_spec = None
+        if self._update_codec is not None:
+            inbound_keyframe_spec = inbound_spec
+            outbound_keyframe_spec = outbound_spec
+            inbound_spec = self._delta_spec(*inbound_spec)
+            outbound_spec = self._delta_spec(*outbound_spec)
 
         # By convention, we set the device for a queue to be
         # on the source of the queue rather than the destination
@@ -191,22 +348,96 @@ class DistributedModule:
             outbound_devices.append(devices_buff)
         for source_ind in range(self._num_sources):
             for module_ind in range(self._num_module):
-                with tf.device(inbound_devices[source_ind][module_ind]):
-                    name = inbound_queues[source_ind][module_ind]
-                    self._update_queues[name] = tf.queue.FIFOQueue(
-                        capacity=10, dtypes=dtypes,
-                        shapes=inbound_shapes, names=names,
-                        shared_name=name,
-                        name=name)
+                self._make_queue(inbound_queues[source_ind][module_ind],
+                                 inbound_devices[source_ind][module_ind],
+                                 self._inbound_capacity,
+                                 inbound_spec, inbound_keyframe_spec)
         for module_ind in range(self._num_module):
             for sink_ind in range(self._num_sinks):
-                with tf.device(outbound_devices[module_ind][sink_ind]):
-                    name = outbound_queues[module_ind][sink_ind]
-                    self._update_queues[name] = tf.queue.FIFOQueue(
-                        capacity=10, dtypes=dtypes,
-                        shapes=outbound_shapes, names=names,
-                        shared_name=name,
-                        name=name)
+                self._make_queue(outbound_queues[module_ind][sink_ind],
+                                 outbound_devices[module_ind][sink_ind],
+                                 self._outbound_capacity,
+                                 outbound_spec, outbound_keyframe_spec)
+
+        # Build the relay queues from every task to its children, these
+        # carry the same elements as the inbound queues.
+        if self._fanout is not None:
+            for module_ind in range(self._num_module):
+                for child_ind in self._children(module_ind):
+                    self._make_queue(
+                        self._relay_queue(module_ind, child_ind),
+                        self.cluster.get_device(
+                            self._module_name, module_ind),
+                        self._inbound_capacity,
+                        inbound_spec, inbound_keyframe_spec)
+
+    def _children(self, module_ind):
+        """
+        The module_name tasks module_ind relays to. Index -1 stands for
+        data_source, the root of the tree.
+        """
+        first = self._fanout * (module_ind + 1)
+        return list(range(first, min(first + self._fanout,
+                                     self._num_module)))
+
+    def _parent(self, module_ind):
+        return module_ind // self._fanout - 1
+
+    def _relay_queue(self, parent_ind, child_ind):
+        prefix = f"{self._module_name}RelayFrom{self._data_source}"
+        return f"{prefix}({parent_ind},{child_ind})"
+
+    def _forward(self, name, element):
+        """
+        Relay an element dequeued from the queue called name on to the
+        children of this task. Returns the element, copied over to this
+        task if it was relayed.
+        """
+        if self._fanout is None or not self._is_module or \
+           not self._children(self._index):
+            return element
+        # Copy it over once, rather than once per child and once more
+        # when it is applied.
+        with tf.device(self.cluster.get_device(
+                self._module_name, self._index)):
+            element = {k: tf.identity(v) for k, v in element.items()}
+        suffix = "Keyframe" if name.endswith("Keyframe") else ""
+        for child_ind in self._children(self._index):
+            relay_name = self._relay_queue(self._index, child_ind) + suffix
+            queue = self._update_queues[relay_name]
+            # Never block on a child which has fallen behind, it only
+            # needs the newest element and gets the next one anyway.
+            if queue.size() >= self._capacities[relay_name]:
+                print(f"Relay queue to {child_ind} is full")
+                continue
+            queue.enqueue(element)
+        return element
+
+    def _delta_spec(self, dtypes, shapes, names):
+        dtypes, shapes, names = codecs.encoded_spec(
+            dtypes, shapes, names, self._update_codec)
+        return (dtypes + [tf.int64], shapes + [[]],
+                names + [self.BASE_KEY])
+
+    def _make_queue(self, name, device, capacity, spec,
+                    keyframe_spec=None):
+        dtypes, shapes, names = spec
+        if self._max_queue_bytes is not None:
+            element_bytes = sum(
+                tf.as_dtype(d).size * tf.TensorShape(s).num_elements()
+                for d, s in zip(dtypes, shapes))
+            capacity = max(1, min(
+                capacity, self._max_queue_bytes // element_bytes))
+        self._capacities[name] = capacity
+        with tf.device(device):
+            self._update_queues[name] = tf.queue.FIFOQueue(
+                capacity=capacity, dtypes=dtypes,
+                shapes=shapes, names=names,
+                shared_name=name,
+                name=name)
+        if keyframe_spec is not None:
+            self._make_queue(name + "Keyframe", device, capacity,
+                             keyframe_spec)
 
     def push(self, data=None, force_ind=None):
 
@@ -215,77 +446,498 @@ class DistributedModule:
             self._is_module and self._num_module)
         assert not (self._push_to_all and (force_ind is not None))
 
-        num_sinks = self._num_module if self._is_source else self._num_sinks
-        if force_ind is not None:
-            sink_inds = [force_ind]
-        elif not self._push_to_all:
-            sink_inds = [
-                np.random.choice(
-                    range(num_sinks))
-            ]
-        else:
-            # push to all
-            sink_inds = list(range(num_sinks))
-
-        if self._is_source:
-            prefix = f"{self._module_name}InboundFrom{self._data_source}"
+        prefix, sink_inds = self._destinations(force_ind)
+
+        if self._compile_push and not data and self._update_codec is None:
+            names = tuple(f"{prefix}({self._index},{sink_ind})"
+                          for sink_ind in sink_inds)
+            if self._versioned:
+                self.version += 1
+            self._publish_fn(names)(tf.constant(self.version, tf.int64))
+            print("Pushed updates")
+            return
+
+        suffix = ""
+        if data:
+            # If we have data, we send it
+            assert self._update_codec is None, \
+                "An update_codec only applies to the module variables"
+            payload = {k: v for k, v in data.items()}
         else:
-            prefix = f"{self._module_name}OutboundTo{self._data_sink}"
+            # If we do not have data, assume we are sending
+            # the variables from the current module
+            payload = {v.name: v for v in self.variables}
+        if self._versioned:
+            self.version += 1
+        if self._update_codec is not None:
+            suffix, payload = self._encode(payload)
+        if self._versioned:
+            payload[self.VERSION_KEY] = self.version
 
         num_sources = self._num_sources if self._is_source else self._num_module
         for source_ind in range(num_sources):
             if source_ind != self._index:
                 continue
             for sink_ind in sink_inds:
-                name = f"{prefix}({source_ind},{sink_ind})"
-                if data:
-                    # If we have data, we send it
-                    self._update_queues[name].enqueue({
-                        k: v for k, v in data.items()
-                    })
-                else:
-                    # If we do not have data, assume we are sending
-                    # the variables from the current module
-                    self._update_queues[name].enqueue({
-                        v.name: v for v in self.variables
-                    })
+                name = f"{prefix}({source_ind},{sink_ind}){suffix}"
+                queue = self._update_queues[name]
+                # A versioned destination only needs the newest element,
+                # so one which has fallen behind is skipped rather than
+                # holding up every other one. It gets the next push.
+                if self._versioned and \
+                   queue.size() >= self._capacities[name]:
+                    print(f"Queue to {sink_ind} is full")
+                    continue
+                queue.enqueue(payload)
                 print("Pushed updates")
 
-    def pull(self, wait=True, return_data=False):
-        assert self._is_sink or self._is_module
-        assert (self._is_sink and self._num_sinks) or (
-            self._is_module and self._num_module)
+    def _publish_fn(self, names):
+        """
+        A tf.function enqueueing the module variables, and the version
+        it is given when versioned, to the queues in names. Traced once
+        per set of queues. Like push(), full versioned queues are
+        skipped.
+        """
+        if names not in self._publish_fns:
+            queues = [(self._update_queues[name], self._capacities[name])
+                      for name in names]
+
+            @tf.function
+            def publish(version):
+                payload = {v.name: v.read_value() for v in self.variables}
+                if self._versioned:
+                    payload[self.VERSION_KEY] = version
+                for queue, capacity in queues:
+                    if not self._versioned:
+                        queue.enqueue(payload)
+                        continue
 
+                    def enqueue(queue=queue):
+                        queue.enqueue(payload)
+
+                    tf.cond(queue.size() < capacity, enqueue, lambda: None)
+
+            self._publish_fns[names] = publish
+        return self._publish_fns[names]
+
+    def _destinations(self, force_ind=None):
+        """
+        The prefix of the queues a push goes out on and the indices of
+        the destinations it goes to.
+        """
+        num_sinks = self._num_module if self._is_source else self._num_sinks
+        if self._is_source:
+            prefix = f"{self._module_name}InboundFrom{self._data_source}"
+        else:
+            prefix = f"{self._module_name}OutboundTo{self._data_sink}"
+
+        if force_ind is not None:
+            sink_inds = [force_ind]
+        elif not self._push_to_all:
+            sink_inds = [self._route(prefix, num_sinks)]
+        elif self._is_source and self._fanout is not None:
+            # The rest of the module tasks get it through the tree
+            sink_inds = self._children(-1)
+        else:
+            # push to all
+            sink_inds = list(range(num_sinks))
+        return prefix, sink_inds
+
+    def push_async(self, data):
+        """
+        Stage data to be pushed by a background thread and return
+        straight away. Whatever is staged when the thread gets to it is
+        sent with a single enqueue_many per destination.
+        """
+        assert self._is_source or self._is_module
+        assert self._staging_capacity > 0, "push_async needs staging"
+        assert not self._versioned, "Versioned pushes are not staged"
+        if self._sender_error is not None:
+            raise self._sender_error
+        if self._sender is None:
+            self._sender = threading.Thread(
+                target=self._send_staged, daemon=True)
+            self._sender.start()
+
+        with self._staging_cond:
+            if len(self._staged) >= self._staging_capacity:
+                if self._staging_overflow == "drop_newest":
+                    self.dropped += 1
+                    return
+                if self._staging_overflow == "drop_oldest":
+                    self._staged.popleft()
+                    self.dropped += 1
+                else:
+                    self._staging_cond.wait_for(
+                        lambda: len(self._staged) < self._staging_capacity)
+            # Copied since the caller may reuse its arrays, such as the
+            # shared memory Env or a chunk of the replay add() buffer,
+            # before the sender gets to them.
+            self._staged.append(
+                {k: np.array(v, copy=True) for k, v in data.items()})
+            self._staging_cond.notify_all()
+
+    def flush(self):
+        """
+        Wait until everything given to push_async() has been enqueued.
+        """
+        with self._staging_cond:
+            self._staging_cond.wait_for(
+                lambda: (not self._staged and not self._sending)
+                or self._sender_error is not None)
+        if self._sender_error is not None:
+            raise self._sender_error
+
+    def _send_staged(self):
+        try:
+            while True:
+                with self._staging_cond:
+                    self._staging_cond.wait_for(lambda: self._staged)
+                    prefix, sink_inds = self._destinations()
+                    names = [f"{prefix}({self._index},{sink_ind})"
+                             for sink_ind in sink_inds]
+                    n = min([len(self._staged)] + [
+                        self._capacities[name] for name in names])
+                    batch = [self._staged.popleft() for _ in range(n)]
+                    self._sending = n
+                    self._staging_cond.notify_all()
+
+                elements = {k: np.stack([e[k] for e in batch])
+                            for k in batch[0]}
+                for name in names:
+                    self._update_queues[name].enqueue_many(elements)
+                print(f"Pushed {n} staged updates")
+
+                with self._staging_cond:
+                    self._sending = 0
+                    self._staging_cond.notify_all()
+        except Exception as e:
+            # Surfaced by push_async() and flush()
+            with self._staging_cond:
+                self._sender_error = e
+                self._staging_cond.notify_all()
+
+    def _route(self, prefix, num_sinks):
+        """
+        Pick the destination of a push according to self._routing.
+        """
+        if self._routing == "round_robin":
+            sink_ind = self._next_sink % num_sinks
+            self._next_sink = sink_ind + 1
+            return sink_ind
+        if self._routing == "least_loaded":
+            # Our queues live on this task, so their sizes are cheap
+            sizes = [self._update_queues[
+                f"{prefix}({self._index},{s})"].size()
+                     for s in range(num_sinks)]
+            return int(np.argmin(sizes))
+        if self._routing == "hash":
+            # Rendezvous hashing, a task keeps its destination no
+            # matter how the other tasks are routed.
+            task = f"{self._data_source}:{self._index}"
+            return int(np.argmax([
+                zlib.crc32(f"{task}->{s}".encode())
+                for s in range(num_sinks)]))
+        return np.random.choice(range(num_sinks))
+
+    def _encode(self, values):
+        """
+        Encode the variables for version self.version. Returns the
+        suffix of the queues to send them on and the queue element.
+        """
+        if (self.version - 1) % self._keyframe_interval == 0:
+            self._push_keyframe = (self.version, {
+                k: tf.identity(v) for k, v in values.items()})
+            return "Keyframe", values
+        base, keyframe = self._push_keyframe
+        encoded = codecs.encode_delta(
+            {k: tf.convert_to_tensor(v) for k, v in values.items()},
+            keyframe, self._update_codec)
+        encoded[self.BASE_KEY] = base
+        return "", encoded
+
+    def _pull_queues(self):
+        """
+        The (source index, queue name) of every queue pull() reads from.
+        """
         if self._is_module:
             prefix = f"{self._module_name}InboundFrom{self._data_source}"
         else:
             prefix = f"{self._module_name}OutboundTo{self._data_sink}"
 
         num_source = self._num_module if self._is_sink else self._num_sources
-        num_sink = self._num_module if self._is_module else self._num_sinks
+        if self._is_module and self._fanout is not None and \
+           self._index >= self._fanout:
+            # Below the first level of the tree updates come from the
+            # parent task instead of data_source.
+            parent_ind = self._parent(self._index)
+            return [(parent_ind, self._relay_queue(parent_ind, self._index))]
+        return [(s, f"{prefix}({s},{self._index})")
+                for s in range(num_source)]
+
+    def _has_update(self, name):
+        if self._update_codec is not None and \
+           self._update_queues[name + "Keyframe"].size() > 0:
+            return True
+        return self._update_queues[name].size() > 0
+
+    def _rotated(self, queues):
+        """
+        queues starting after the last source pulled from, so a source
+        which always has elements cannot starve the others.
+        """
+        start = 0 if self.last_source is None else self.last_source + 1
+        return queues[start % len(queues):] + queues[:start % len(queues)]
+
+    def _ready_source(self, queues, timeout=None):
+        """
+        Wait until one of queues holds an element.
 
-        def avaialble_updates():
-            return [self._update_queues[f"{prefix}({s},{self._index})"].size() for s in
-                    range(num_source)]
-        if wait:
-            while np.sum(avaialble_updates()) == 0:
+        queues: a list of (source index, queue name)
+        timeout: how long to wait in seconds, 0 checks once and None
+                 waits forever
+
+        Returns the source index of the first ready queue, or None if
+        the timeout expired.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        interval = self.min_poll_interval
+        waiting = False
+        while True:
+            for source_ind, name in queues:
+                if self._has_update(name):
+                    return source_ind
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                return None
+            if not waiting:
                 print("waiting for update")
-                time.sleep(1)
+                waiting = True
+            if deadline is not None:
+                interval = min(interval, deadline - now)
+            time.sleep(interval)
+            interval = min(interval * 2, self.max_poll_interval)
 
-        for source_ind in range(num_source):
-            for sink_ind in range(num_sink):
-                if sink_ind != self._index:
-                    continue
-                name = f"{prefix}({source_ind},{sink_ind})"
-                if self._update_queues[name].size() > 0:
-                    update = self._update_queues[name].dequeue()
-                    print("Pulled update")
-                    if self._is_sink and return_data:
-                        return update
-                    self._base_model.handle_data(update)
-                    return
+    def wait_for_update(self, timeout=None):
+        """
+        Wait until any source has sent an element to this module.
+        Returns the index of the first source with an element, or None
+        if nothing arrived within timeout seconds.
+        """
+        return self._ready_source(self._pull_queues(), timeout)
+
+    def pull(self, wait=True, return_data=False, timeout=None):
+        """
+        Dequeue one element from the first source which has one,
+        starting after the source of the last pull.
+
+        wait: wait for an element if none is available yet
+        return_data: return the element rather than calling handle_data
+        timeout: when waiting, give up after this many seconds
+        """
+        assert self._is_sink or self._is_module
+        assert (self._is_sink and self._num_sinks) or (
+            self._is_module and self._num_module)
+
+        queues = self._rotated(self._pull_queues())
+        source_ind = self._ready_source(queues, timeout if wait else 0)
+        if source_ind is not None:
+            name = dict(queues)[source_ind]
+            queue = self._update_queues[name]
+            if self._update_codec is not None:
+                update = self._pull_encoded(name)
+                if update is None:
+                    return None
+            elif self._versioned:
+                update = self._dequeue_latest(name)
+                if update is None:
+                    return None
+            else:
+                update = self._forward(name, queue.dequeue())
+            self.last_source = source_ind
+            print("Pulled update")
+            if return_data:
+                return update
+            self._base_model.handle_data(update)
+            return
         print("No updates")
         return None
 
+    def _dequeue_newest(self, queue_name):
+        """
+        Dequeue the newest element of a versioned queue, dropping
+        everything queued before it. Returns its version and the rest
+        of the element.
+        """
+        queue = self._update_queues[queue_name]
+        stale = int(queue.size()) - 1
+        if stale > 0:
+            # Run on the queue's device and never read the result so the
+            # dropped elements are not copied over to this task.
+            with tf.device(queue.queue_ref.device):
+                queue.dequeue_many(stale)
+            print(f"Skipped {stale} stale updates")
+        update = dict(self._forward(queue_name, queue.dequeue()))
+        return int(update.pop(self.VERSION_KEY)), update
+
+    def _dequeue_latest(self, queue_name):
+        """
+        The newest element of a versioned queue, or None if it is not
+        newer than the version this module already holds.
+        """
+        version, update = self._dequeue_newest(queue_name)
+        if version <= self.version:
+            print("Skipped stale update")
+            return None
+        self.version = version
+        return update
+
+    def _pull_encoded(self, name):
+        """
+        The newest variables sent on an encoded queue and its keyframe
+        queue, or None if neither holds anything newer than the version
+        this module already holds.
+        """
+        keyframe_queue = self._update_queues[name + "Keyframe"]
+        if keyframe_queue.size() > 0:
+            version, keyframe = self._dequeue_newest(name + "Keyframe")
+            if version > self._pull_keyframe[0]:
+                # Keep a local copy, every following delta is decoded
+                # against it.
+                self._pull_keyframe = (version, {
+                    k: tf.constant(v.numpy()) for k, v in keyframe.items()})
+
+        update = None
+        base, keyframe = self._pull_keyframe
+        if base > self.version:
+            update = keyframe
+            self.version = base
+
+        queue = self._update_queues[name]
+        if queue.size() > 0:
+            version, delta = self._dequeue_newest(name)
+            # A delta against a keyframe we never got cannot be decoded
+            if int(delta.pop(self.BASE_KEY)) == base and \
+               version > self.version:
+                update = codecs.decode_delta(
+                    delta, keyframe, self._update_codec)
+                self.version = version
+
+        if update is None:
+            print("Skipped stale update")
+        return update
+
+    def pull_many(self, max_items, wait=True, return_data=False,
+                  timeout=None):
+        """
+        Drain up to max_items elements across all source queues and
+        hand them to handle_data as a single batch. Elements are
+        stacked along a new leading dimension, or concatenated along
+        their own batch dimension when inbound_size (outbound_size for
+        sinks) is set. Only meaningful for data, not model weights.
+
+        max_items: the maximum number of queue elements to dequeue
+        wait: block until at least one element is available
+        return_data: return the batch rather than calling handle_data
+        timeout: when waiting, give up after this many seconds
+
+        Returns None when there was nothing to pull.
+        """
+        assert self._is_sink or self._is_module
+        assert (self._is_sink and self._num_sinks) or (
+            self._is_module and self._num_module)
+        assert max_items > 0
+        assert self._update_codec is None and self._fanout is None, \
+            "Weight broadcasts can only be pulled one at a time"
+
+        queues = self._pull_queues()
+        if wait and self._ready_source(queues, timeout) is None:
+            print("No updates")
+            return None
+
+        element_size = self._inbound_size if self._is_module \
+            else self._outbound_size
+
+        queues = self._rotated(queues)
+
+        batches = []
+        remaining = max_items
+        for source_ind, name in queues:
+            if remaining == 0:
+                break
+            queue = self._update_queues[name]
+            # We are the only consumer of this queue so it can only
+            # grow, dequeue_many(n) will not block.
+            n = min(int(queue.size()), remaining)
+            if n == 0:
+                continue
+            batch = queue.dequeue_many(n)
+            if element_size > 0:
+                batch = {k: tf.reshape(v, [-1] + v.shape[2:].as_list())
+                         for k, v in batch.items()}
+            batches.append(batch)
+            remaining -= n
+            self.last_source = source_ind
+
+        if not batches:
+            print("No updates")
+            return None
+
+        update = {k: tf.concat([b[k] for b in batches], axis=0)
+                  for k in batches[0]}
+        print(f"Pulled {max_items - remaining} updates")
+        if return_data:
+            return update
+        self._base_model.handle_data(update)
+
     def maybe_update(self):
         return self.pull(wait=False)
+
+class QueueModule(DistributedModule):
+    """
+    A DistributedModule which moves the tensors described by spec
+    rather than the variables of a model.
+
+    spec: a dict mapping names to the shape of a single element
+    dtypes: an optional dict mapping names to dtypes, anything missing
+            is sent as tf.float32
+    """
+    def __init__(self, spec, dtypes=None, **kwargs):
+        self._spec = spec
+        self._dtypes = dtypes or {}
+        super().__init__(None, **kwargs)
+
+    @property
+    def distributed_variables(self):
+        return [
+            Variable(shape=list(shape), name=k,
+                     dtype=self._dtypes.get(k, tf.float32))
+            for k, shape in self._spec.items()]
+
+    def _inbound_queue(self, source_ind):
+        prefix = f"{self._module_name}InboundFrom{self._data_source}"
+        return self._update_queues[f"{prefix}({source_ind},{self._index})"]
+
+    def pull_ready(self, skip=()):
+        """
+        Dequeue one element from every source which has one available.
+        Returns a dict mapping source index to the element.
+        """
+        ready = {}
+        for source_ind in range(self._num_sources):
+            if source_ind in skip:
+                continue
+            queue = self._inbound_queue(source_ind)
+            if queue.size() > 0:
+                ready[source_ind] = queue.dequeue()
+        return ready
+
+    def pull_from(self, source_ind, timeout=None):
+        """
+        Wait until source_ind sends an element and return it, or None
+        if nothing arrived within timeout seconds.
+        """
+        queues = [q for q in self._pull_queues() if q[0] == source_ind]
+        if self._ready_source(queues, timeout) is None:
+            return None
+        return self._inbound_queue(source_ind).dequeue()
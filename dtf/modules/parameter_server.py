@@ -0,0 +1,158 @@
+import tensorflow as tf
+import numpy as np
+import time
+
+from .distributed_module import DistributedModule
+
+class ParameterServerModule(DistributedModule):
+    """
+    A DistributedModule which shares the variables of a model through
+    a job of parameter servers rather than through queues. The
+    variables are split by size across the ps tasks, data_source
+    writes every shard to its ps task once per push and every
+    module_name task reads all the shards in parallel when it pulls.
+
+    The ps tasks only have to run a server. Like any asynchronous
+    parameter server, a pull racing a push can mix shards of two
+    consecutive versions.
+    """
+    def __init__(self, base_model, ps_name="ps", **kwargs):
+        """
+        base_model: the DistributedModel whose variables are shared
+        ps_name: the job in the cluster holding the shards
+        """
+        self._ps_name = ps_name
+        super().__init__(base_model, **kwargs)
+        assert not self._data_sink, \
+            "Shards are only pushed by data_source to module_name"
+
+    def _make_queues(self):
+        # Instead of queues build one shared variable per model variable
+        # on the ps task it is assigned to, and one version per ps task.
+        num_ps = self.cluster.count(self._ps_name)
+        variables = self.distributed_variables
+
+        # Greedily place the largest variables first on the least
+        # loaded ps task.
+        loads = np.zeros(num_ps)
+        self._shards = [[] for _ in range(num_ps)]
+        order = sorted(range(len(variables)),
+                       key=lambda i: -variables[i].shape.num_elements())
+        for i in order:
+            ps_ind = int(np.argmin(loads))
+            self._shards[ps_ind].append(i)
+            loads[ps_ind] += variables[i].shape.num_elements()
+
+        prefix = f"{self._module_name}From{self._data_source}"
+        self._handles = [None] * len(variables)
+        self._version_handles = []
+        for ps_ind in range(num_ps):
+            device = self.cluster.get_device(self._ps_name, ps_ind)
+            with tf.device(device):
+                for i in self._shards[ps_ind]:
+                    self._handles[i] = tf.raw_ops.VarHandleOp(
+                        dtype=variables[i].dtype,
+                        shape=variables[i].shape,
+                        shared_name=f"{prefix}Shard({i})")
+                self._version_handles.append(tf.raw_ops.VarHandleOp(
+                    dtype=tf.int64, shape=[],
+                    shared_name=f"{prefix}Version({ps_ind})"))
+
+    def _device(self, ps_ind):
+        return self.cluster.get_device(self._ps_name, ps_ind)
+
+    @tf.function
+    def _publish(self, version):
+        for ps_ind, shard in enumerate(self._shards):
+            with tf.device(self._device(ps_ind)):
+                assigns = [
+                    tf.raw_ops.AssignVariableOp(
+                        resource=self._handles[i],
+                        value=self.variables[i])
+                    for i in shard]
+                # Only bump the version once the shard is written
+                with tf.control_dependencies(assigns):
+                    tf.raw_ops.AssignVariableOp(
+                        resource=self._version_handles[ps_ind],
+                        value=version)
+
+    @tf.function
+    def _read_versions(self):
+        versions = []
+        for ps_ind in range(len(self._shards)):
+            with tf.device(self._device(ps_ind)):
+                versions.append(tf.raw_ops.ReadVariableOp(
+                    resource=self._version_handles[ps_ind],
+                    dtype=tf.int64))
+        return versions
+
+    @tf.function
+    def _fetch(self):
+        # Every read is independent, so the shards come in from all
+        # ps tasks at once.
+        values = [None] * len(self._handles)
+        versions = []
+        for ps_ind, shard in enumerate(self._shards):
+            with tf.device(self._device(ps_ind)):
+                for i in shard:
+                    values[i] = tf.raw_ops.ReadVariableOp(
+                        resource=self._handles[i],
+                        dtype=self.variables[i].dtype)
+                versions.append(tf.raw_ops.ReadVariableOp(
+                    resource=self._version_handles[ps_ind],
+                    dtype=tf.int64))
+        return values, versions
+
+    def _published_version(self):
+        try:
+            return int(np.min(self._read_versions()))
+        except (tf.errors.NotFoundError,
+                tf.errors.FailedPreconditionError):
+            # Nothing has been pushed to some ps task yet
+            return 0
+
+    def push(self, data=None, force_ind=None):
+        assert self._is_source
+        assert data is None and force_ind is None, \
+            "Only the module variables can be pushed to the ps job"
+        self.version += 1
+        self._publish(tf.constant(self.version, tf.int64))
+        print("Pushed updates")
+
+    def wait_for_update(self, timeout=None):
+        """
+        Wait until every ps task holds a version newer than ours.
+        Returns that version, or None if the timeout expired.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        interval = self.min_poll_interval
+        while True:
+            version = self._published_version()
+            if version > self.version:
+                return version
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                return None
+            if deadline is not None:
+                interval = min(interval, deadline - now)
+            time.sleep(interval)
+            interval = min(interval * 2, self.max_poll_interval)
+
+    def pull(self, wait=True, return_data=False, timeout=None):
+        assert self._is_module
+        if self.wait_for_update(timeout if wait else 0) is None:
+            print("No updates")
+            return None
+
+        values, versions = self._fetch()
+        self.version = int(np.min(versions))
+        update = {v.name: value
+                  for v, value in zip(self.variables, values)}
+        print("Pulled update")
+        if return_data:
+            return update
+        self._base_model.handle_data(update)
+
+    def pull_many(self, max_items, wait=True, return_data=False,
+                  timeout=None):
+        raise RuntimeError("Weights are pulled whole from the ps job")
@@ -0,0 +1,71 @@
+import tensorflow as tf
+
+# Codecs understood by DistributedModule(update_codec=...), mapped to
+# the dtype a delta is sent as.
+CODECS = {
+    "float16": tf.float16,
+    "int8": tf.int8,
+}
+
+def scale_name(name):
+    return name + "/scale"
+
+def encoded_spec(dtypes, shapes, names, codec):
+    """
+    The queue spec of an encoded update. Floating point entries are
+    sent in the codec dtype, int8 entries also carry a float32 scale.
+    Everything else is sent as is.
+    """
+    assert codec in CODECS, f"Unknown update codec {codec}"
+    enc_dtypes, enc_shapes, enc_names = [], [], []
+    for dtype, shape, name in zip(dtypes, shapes, names):
+        dtype = tf.as_dtype(dtype)
+        if not dtype.is_floating:
+            enc_dtypes.append(dtype)
+            enc_shapes.append(shape)
+            enc_names.append(name)
+            continue
+        enc_dtypes.append(CODECS[codec])
+        enc_shapes.append(shape)
+        enc_names.append(name)
+        if codec == "int8":
+            enc_dtypes.append(tf.float32)
+            enc_shapes.append([])
+            enc_names.append(scale_name(name))
+    return enc_dtypes, enc_shapes, enc_names
+
+def encode_delta(values, keyframe, codec):
+    """
+    Encode the difference between values and keyframe, both dicts
+    mapping names to tensors.
+    """
+    encoded = {}
+    for k, v in values.items():
+        if not v.dtype.is_floating:
+            encoded[k] = v
+            continue
+        delta = v - keyframe[k]
+        if codec == "float16":
+            encoded[k] = tf.cast(delta, tf.float16)
+        else:
+            scale = tf.reduce_max(tf.abs(delta)) / 127.
+            scale = tf.where(scale > 0, scale, tf.ones_like(scale))
+            encoded[k] = tf.cast(tf.round(delta / scale), tf.int8)
+            encoded[scale_name(k)] = tf.cast(scale, tf.float32)
+    return encoded
+
+def decode_delta(encoded, keyframe, codec):
+    """
+    Rebuild the values an encoded delta was made from, given the same
+    keyframe it was encoded against.
+    """
+    values = {}
+    for k, base in keyframe.items():
+        if not base.dtype.is_floating:
+            values[k] = encoded[k]
+            continue
+        delta = tf.cast(encoded[k], base.dtype)
+        if codec == "int8":
+            delta = delta * tf.cast(encoded[scale_name(k)], base.dtype)
+        values[k] = base + delta
+    return values
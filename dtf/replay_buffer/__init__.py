@@ -1,4 +1,9 @@
 from .base_replay_buffer import ReplayBuffer
 from .base_replay_buffer import get_replay_buffer
+from .base_replay_buffer import parse_storage_spec
+from .prioritized_replay_buffer import PrioritizedReplayBuffer
+from .memmap_replay_buffer import MemmapReplayBuffer
+from .frame_replay_buffer import FrameReplayBuffer
+from .sequence_replay_buffer import SequenceReplayBuffer
 
 from .distributed_replay_buffer import DistributedRelayBuffer
@@ -1,37 +1,102 @@
 import tensorflow as tf
 import numpy as np
+import contextlib
+import threading
 
 from dtf.modules import DistributedModel
+from dtf.replay_buffer import snapshot as snapshots
+
+def parse_storage_spec(storage_spec):
+    """
+    Split a storage_spec into a dict of shapes and a dict of tf dtypes.
+    Every entry is either a shape, which is stored as tf.float32, or a
+    (shape, dtype) pair such as ((84, 84, 3), np.uint8).
+    """
+    shapes = {}
+    dtypes = {}
+    for k, v in storage_spec.items():
+        if len(v) == 2 and isinstance(v[0], (list, tuple)):
+            shape, dtype = v
+        else:
+            shape, dtype = v, tf.float32
+        shapes[k] = tuple(shape)
+        dtypes[k] = tf.as_dtype(dtype)
+    return shapes, dtypes
 
 class ReplayBuffer(DistributedModel):
 
     def __init__(self, storage_spec, capacity):
         super().__init__(update_method='scatter')
         self.storage_spec = storage_spec
+        self.storage_shapes, self.storage_dtypes = \
+            parse_storage_spec(storage_spec)
         self.capacity = capacity
 
         self.size = -1
+        # The next slot to write to, once the buffer is full this is
+        # the oldest transition which gets evicted first.
+        self._cursor = 0
+
+        # Slots written since the last snapshot
+        self._dirty = np.zeros(capacity, dtype=bool)
+        # The directory the incremental snapshots are kept in, the
+        # number of the next one and the slots saved incrementally since
+        # the last full one
+        self._snapshot_dir = None
+        self._snapshot_number = 0
+        self._snapshot_rows = 0
+        self._snapshot_thread = None
+        # The snapshot being written, if any
+        self._snapshot_pending = None
+
+        self.storage = self._make_storage()
 
-        self.storage = {}
-        for k, shape in self.storage_spec.items():
-            self.storage[k] = tf.Variable(
+    def _make_storage(self):
+        storage = {}
+        for k, shape in self.storage_shapes.items():
+            # Build the initial value directly in the storage dtype so
+            # startup does not hold a float64 copy of the whole buffer.
+            dtype = self.storage_dtypes[k]
+            storage[k] = tf.Variable(
                 shape=(self.capacity, *shape),
                 name=k,
-                initial_value=np.zeros([self.capacity, *shape]),
-                dtype=tf.float32)
+                initial_value=tf.zeros([self.capacity, *shape],
+                                       dtype=dtype),
+                dtype=dtype)
+        return storage
+
+    def _read(self, k, idx):
+        return tf.gather(self.storage[k], idx)
+
+    def _write(self, k, idx, values):
+        self._touch(idx)
+        # Write in place so an add only touches the batch rows
+        # instead of materializing a new [capacity, ...] tensor.
+        self.storage[k].scatter_nd_update(
+            idx[:, None], tf.cast(values, self.storage[k].dtype))
+
+    def _touch(self, idx):
+        """
+        Called by _write() before the slots in idx are overwritten.
+        """
+        pending = self._snapshot_pending
+        if pending is not None:
+            pending.preserve(idx)
+        self._dirty[idx] = True
 
     def clear(self):
         self.size = min(0, self.size)
+        self._cursor = 0
 
-    def get_scatter_index(self):
-        if self.size < self.capacity:
-            self.size = max(self.size, 0)
-            idx = self.size
-            self.size += 1
-        else:
-            idx = np.random.randint(0, self.size)
+    def get_scatter_indices(self, n):
+        idx = (self._cursor + np.arange(n)) % self.capacity
+        self._cursor = (self._cursor + n) % self.capacity
+        self.size = min(max(self.size, 0) + n, self.capacity)
         return idx
 
+    def get_scatter_index(self):
+        return self.get_scatter_indices(1)[0]
+
     def sample(self):
         return self.sample_n(1)
 
@@ -43,7 +108,7 @@ class ReplayBuffer(DistributedModel):
         idx = np.random.randint(0, self.size, size=n)
         ret = {}
         for k in self.storage:
-            ret[k] = tf.gather(self.storage[k], idx)
+            ret[k] = self._read(k, idx)
         return ret
 
     def add(self, to_add):
@@ -56,22 +121,169 @@ class ReplayBuffer(DistributedModel):
                 assert dim == batch_dim
         assert batch_dim > 0
 
-        idx = [[self.get_scatter_index()] for _ in range(batch_dim)]
+        # Anything beyond the last capacity items would be overwritten
+        # within this same batch anyway.
+        skip = max(batch_dim - self.capacity, 0)
+        self._cursor = (self._cursor + skip) % self.capacity
+        idx = self.get_scatter_indices(batch_dim - skip)
 
         for k in self.storage:
             assert k in to_add, f"You are missing {k} in your data"
             if len(to_add[k].shape) != len(self.storage[k].shape):
                 to_add[k] = [to_add[k]]
 
-            self.storage[k] = tf.tensor_scatter_nd_update(
-                self.storage[k], idx, to_add[k])
+            self._write(k, idx, to_add[k][skip:])
+
+        return idx
+
+    @property
+    def sample_spec(self):
+        """
+        Entries returned by sample_n() which are not in storage_spec,
+        or which are returned with a different shape or dtype, as a
+        dict mapping names to (shape, dtype).
+        """
+        return {}
+
+    @property
+    def sampling_mass(self):
+        """
+        The total weight sample_n() draws from, the number of stored
+        transitions unless some are more likely to be sampled.
+        """
+        return max(self.size, 0)
 
     def handle_data(self, data):
         # Handle incoming data in the case of a distributed replay
         self.add(data)
 
+    def _snapshot_state(self):
+        """
+        Everything besides the storage needed to sample from a restored
+        buffer, as a dict of numpy arrays. Saved whole every snapshot.
+        """
+        return {"size": np.int64(self.size),
+                "cursor": np.int64(self._cursor)}
+
+    def _restore_state(self, state):
+        self.size = int(state["size"])
+        self._cursor = int(state["cursor"])
+
+    def snapshot(self, directory, full=False, background=False,
+                 chunk_size=4096, lock=None):
+        """
+        Save the slots written since the last snapshot to directory, in
+        compressed chunks of chunk_size slots. The first snapshot to a
+        directory the buffer was not restored from is a full one, as
+        is every snapshot once the incremental ones add up to the
+        capacity, which bounds the disk use to about twice the buffer.
+
+        The slots are copied out one chunk at a time, so a snapshot
+        never holds more than a chunk in memory. It still saves the
+        buffer as it was when snapshot() was called: slots written in
+        the meantime have their old rows kept until they are saved, and
+        go into the next snapshot with their new rows.
+
+        background: copy, compress and write the chunks on a new
+                    thread, which is returned. Any earlier snapshot is
+                    finished first.
+        lock: held while picking the slots and while copying each
+              chunk, but not while compressing or writing, when other
+              threads write to the buffer. Those threads have to hold
+              it while writing too.
+        """
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join()
+            self._snapshot_thread = None
+        lock = lock or contextlib.nullcontext()
+
+        with lock:
+            if directory != self._snapshot_dir:
+                manifest = snapshots.read_manifest(directory)
+                self._snapshot_number = 0 if manifest is None \
+                    else manifest["snapshots"][-1][0] + 1
+                full = True
+            idx = np.flatnonzero(self._dirty)
+            if self._snapshot_rows + len(idx) > self.capacity:
+                full = True
+            if full:
+                idx = np.arange(self.capacity)
+            self._dirty[:] = False
+            pending = snapshots.Snapshot(
+                directory, self._snapshot_number, full, idx,
+                self._snapshot_state(), self._snapshot_chunk,
+                self.capacity, chunk_size, lock)
+            self._snapshot_pending = pending
+        self._snapshot_dir = directory
+        self._snapshot_number += 1
+        self._snapshot_rows = 0 if full else self._snapshot_rows + len(idx)
+
+        if not background:
+            self._write_snapshot(pending)
+            return None
+        self._snapshot_thread = threading.Thread(
+            target=self._write_snapshot, args=(pending,), daemon=True)
+        self._snapshot_thread.start()
+        return self._snapshot_thread
+
+    def _snapshot_chunk(self, idx):
+        """
+        A copy of the storage at idx as a dict of numpy arrays.
+        """
+        return {k: self._read(k, idx).numpy() for k in self.storage}
+
+    def _write_snapshot(self, pending):
+        try:
+            pending.write()
+        except Exception:
+            # The slots of this snapshot are lost from the chain, start
+            # over with a full one.
+            self._snapshot_dir = None
+            raise
+        finally:
+            self._snapshot_pending = None
+
+    def restore(self, directory, num_threads=8):
+        """
+        Load the snapshots in directory into the buffer, decompressing
+        on num_threads threads. Later snapshots go on saving to the
+        same chain. Returns False if directory holds no snapshot.
+        """
+        loaded = snapshots.read_snapshots(directory, num_threads)
+        if loaded is None:
+            return False
+        manifest, chunks, state = loaded
+        for idx, rows in chunks:
+            for k in self.storage:
+                self._write(k, idx, rows[k])
+        self._restore_state(state)
+
+        self._dirty[:] = False
+        self._snapshot_dir = directory
+        self._snapshot_number = manifest["snapshots"][-1][0] + 1
+        self._snapshot_rows = manifest["rows"]
+        return True
+
 def get_replay_buffer(name):
-    if name.lower() == 'replaybuffer' or 'replay':
+    # Imported here since the prioritized buffer builds on ReplayBuffer
+    from .prioritized_replay_buffer import PrioritizedReplayBuffer
+    from .memmap_replay_buffer import MemmapReplayBuffer
+    from .frame_replay_buffer import FrameReplayBuffer
+    from .sequence_replay_buffer import SequenceReplayBuffer
+
+    if name.lower() in ('replaybuffer', 'replay_buffer', 'replay'):
         return ReplayBuffer
+    if name.lower() in ('prioritizedreplaybuffer',
+                        'prioritized_replay_buffer', 'prioritized'):
+        return PrioritizedReplayBuffer
+    if name.lower() in ('memmapreplaybuffer', 'memmap_replay_buffer',
+                        'memmap'):
+        return MemmapReplayBuffer
+    if name.lower() in ('framereplaybuffer', 'frame_replay_buffer',
+                        'frame'):
+        return FrameReplayBuffer
+    if name.lower() in ('sequencereplaybuffer', 'sequence_replay_buffer',
+                        'sequence'):
+        return SequenceReplayBuffer
 
     raise NotImplementedError
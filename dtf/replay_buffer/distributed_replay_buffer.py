@@ -1,9 +1,12 @@
-from dtf.modules import DistributedModule
+from dtf.modules import DistributedModule, QueueModule, Variable
 from dtf.replay_buffer import get_replay_buffer
 
-from collections import namedtuple
-
-Variable = namedtuple("Variable", ("shape", "name", "dtype"))
+import tensorflow as tf
+import numpy as np
+import threading
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 class DistributedRelayBuffer(DistributedModule):
 
@@ -17,11 +20,98 @@ class DistributedRelayBuffer(DistributedModule):
                  # distributed arguments
                  worker_name, learner_name,
                  replay_buffer_name, task_name,
-                 task_index, cluster):
+                 task_index, cluster,
+                 replay_buffer_kwargs=None,
+                 prefetch=2,
+                 ingest_batch_size=32,
+                 routing="random",
+                 staging_capacity=0,
+                 staging_overflow="drop_oldest",
+                 inbound_size=0,
+                 inbound_capacity=10,
+                 outbound_capacity=10,
+                 max_queue_bytes=None,
+                 shard_batches=1,
+                 snapshot_dir=None,
+                 snapshot_interval=600,
+                 max_poll_interval=0.1):
+        """
+        prefetch: the number of sampled batches run() keeps waiting in
+                  the queue to every learner. At most the queue capacity.
+        ingest_batch_size: the most worker elements run() drains across
+                           all worker queues and adds to the replay
+                           buffer at once.
+        routing: how workers pick the replay task for every add(), see
+                 DistributedModule. Has to be "hash" for buffers with a
+                 stream_key.
+        staging_capacity: when above 0 add() stages transitions on the
+                          worker and a background thread sends them,
+                          so stepping never waits on a full queue
+        staging_overflow: what add() does when the staging is full,
+                          see DistributedModule. Has to be "block" for
+                          buffers with a stream_key.
+        inbound_size: when above 0 add() gathers transitions into
+                      chunks of inbound_size and sends one chunk per
+                      enqueue instead of one transition
+        inbound_capacity, outbound_capacity, max_queue_bytes: the
+                      queue sizes, see DistributedModule
+        shard_batches: when above 1 every replay task is treated as a
+                       shard of one global replay buffer. Learners build
+                       each batch from shard_batches micro-batches of
+                       batch_size // shard_batches, drawn from the
+                       shards in proportion to their size (total
+                       priority for prioritized buffers).
+        snapshot_dir: when set every replay task restores its buffer
+                      from its own subdirectory at startup and run()
+                      saves incremental snapshots there
+        snapshot_interval: the seconds between two snapshots
+        max_poll_interval: the most seconds between two checks of the
+                           queues while waiting, see DistributedModule
+        """
+        assert batch_size % shard_batches == 0, \
+            "batch_size has to split evenly into shard_batches"
 
         self.batch_size = batch_size
+        self.shard_batches = shard_batches
+        self.micro_batch_size = batch_size // shard_batches
+        # A learner can draw every micro-batch of a batch from one shard
+        self.prefetch = max(prefetch, shard_batches)
+        assert self.prefetch <= outbound_capacity, \
+            "The learner queues cannot hold the prefetched batches"
+        self.ingest_batch_size = ingest_batch_size
+        # Guards the replay buffer between the ingest thread and the
+        # sampler in run()
+        self._lock = threading.Lock()
+        self._ingest_error = None
+        # Transitions add() holds until it has a full chunk
+        self._partial_chunk = None
+        replay_buffer_kwargs = dict(replay_buffer_kwargs or {})
+        if replay_buffer_kwargs.get("directory") is not None:
+            if task_name == replay_buffer_name:
+                # Replay tasks sharing a host keep their own files
+                replay_buffer_kwargs["directory"] = os.path.join(
+                    replay_buffer_kwargs["directory"],
+                    f"{replay_buffer_name}-{task_index}")
+            else:
+                # The other tasks only need the spec of the buffer
+                del replay_buffer_kwargs["directory"]
         replay_buffer_cls = get_replay_buffer(replay_buffer_type)
-        replay_buffer = replay_buffer_cls(storage_spec, capacity)
+        replay_buffer = replay_buffer_cls(
+            storage_spec, capacity, **replay_buffer_kwargs)
+        # Every add() mixes rows from many workers and time steps, so
+        # buffers linking consecutive transitions need their stream id
+        # rather than the row in the batch.
+        stream_key = getattr(replay_buffer, "stream_key", "")
+        assert stream_key is not None, \
+            "Set stream_key, e.g. to the \"stream\" entry of Env"
+        if stream_key:
+            # They link a transition to the next one of its stream to
+            # arrive, so every transition of a stream has to reach the
+            # same replay task and none may be dropped on the way.
+            assert routing == "hash", \
+                "Buffers with a stream_key need routing=\"hash\""
+            assert staging_capacity == 0 or staging_overflow == "block", \
+                "Buffers with a stream_key need staging_overflow=\"block\""
         super().__init__(replay_buffer,
                          cluster=cluster,
                          data_source=worker_name,
@@ -30,27 +120,301 @@ class DistributedRelayBuffer(DistributedModule):
                          task=task_name,
                          index=task_index,
                          push_to_all=False,
-                         inbound_size=0,
-                         outbound_size=batch_size)
+                         inbound_size=inbound_size,
+                         outbound_size=self.micro_batch_size,
+                         inbound_capacity=inbound_capacity,
+                         outbound_capacity=outbound_capacity,
+                         max_queue_bytes=max_queue_bytes,
+                         routing=routing,
+                         staging_capacity=staging_capacity,
+                         staging_overflow=staging_overflow,
+                         max_poll_interval=max_poll_interval)
+
+        # learner -> replay priority updates for the sampled slots
+        self._priority_updates = None
+        if hasattr(replay_buffer, "update_priorities"):
+            self._priority_updates = QueueModule(
+                {"indices": [self.micro_batch_size],
+                 "priorities": [self.micro_batch_size]},
+                dtypes={"indices": tf.int64},
+                cluster=cluster,
+                data_source=learner_name,
+                module_name=replay_buffer_name,
+                task=task_name,
+                index=task_index)
+            self._update_queues.update(
+                self._priority_updates._update_queues)
+
+        self._snapshot_dir = None
+        self.snapshot_interval = snapshot_interval
+        if snapshot_dir is not None and self._is_module:
+            self._snapshot_dir = os.path.join(
+                snapshot_dir, f"{replay_buffer_name}-{task_index}")
+            if replay_buffer.restore(self._snapshot_dir):
+                print(f"Restored {replay_buffer.size} transitions")
+        self._last_snapshot = time.time()
+
+        # The shard every micro-batch of the last batch came from
+        self._last_shards = None
+        if shard_batches > 1:
+            self._make_fill_handles()
+            # Dequeues the micro-batches of a batch from every shard at
+            # once, each one is a blocking RPC to its replay task.
+            self._dequeue_pool = ThreadPoolExecutor(self._num_module)
 
     def add(self, data):
-        self.push(data)
+        # Only send what the replay buffer stores, e.g. FrameReplayBuffer
+        # rebuilds next_observation itself.
+        data = {k: data[k] for k in self._base_model.storage_shapes}
+        chunks = [data]
+        if self._inbound_size > 0:
+            chunks = self._chunk(data)
+        for chunk in chunks:
+            if self._staging_capacity > 0:
+                self.push_async(chunk)
+            else:
+                self.push(chunk)
+
+    def _chunk(self, data):
+        """
+        Add a transition, or a batch of them, to the partial chunk and
+        return every chunk of inbound_size transitions it completes.
+        """
+        rows = {}
+        for k, shape in self._base_model.storage_shapes.items():
+            rows[k] = np.reshape(np.asarray(data[k]), (-1,) + shape)
+            if self._partial_chunk is not None:
+                rows[k] = np.concatenate([self._partial_chunk[k], rows[k]])
+
+        n = len(next(iter(rows.values())))
+        full = n - n % self._inbound_size
+        self._partial_chunk = {k: v[full:] for k, v in rows.items()}
+        return [{k: v[i:i + self._inbound_size] for k, v in rows.items()}
+                for i in range(0, full, self._inbound_size)]
 
     @property
     def distributed_variables(self):
+        # Built from the spec rather than the storage since not every
+        # storage backend keeps its data in tf.Variables.
+        dtypes = self._base_model.storage_dtypes
         return [
-            Variable(
-                shape=v.shape[1:],
-                name=v.name.split(":")[0],
-                dtype=v.dtype) for v in self._base_model.variables]
+            Variable(shape=list(shape), name=k, dtype=dtypes[k])
+            for k, shape in self._base_model.storage_shapes.items()]
+
+    @property
+    def outbound_variables(self):
+        variables = {v.name: v for v in self.distributed_variables}
+        for k, (shape, dtype) in self._base_model.sample_spec.items():
+            variables[k] = Variable(shape=list(shape), name=k, dtype=dtype)
+        return list(variables.values())
+
+    def _make_fill_handles(self):
+        # Every shard publishes its [size, sampling mass] in a variable
+        # on its own task, shared with the learners by name.
+        self._fill_handles = []
+        for shard in range(self._num_module):
+            with tf.device(self.cluster.get_device(self._module_name, shard)):
+                self._fill_handles.append(tf.raw_ops.VarHandleOp(
+                    dtype=tf.float64, shape=[2],
+                    shared_name=f"{self._module_name}Fill({shard})"))
+
+    def _publish_fill(self):
+        with self._lock:
+            fill = [max(self._base_model.size, 0),
+                    self._base_model.sampling_mass]
+        with tf.device(self.cluster.get_device(self._module_name,
+                                               self._index)):
+            tf.raw_ops.AssignVariableOp(
+                resource=self._fill_handles[self._index],
+                value=tf.constant(fill, tf.float64))
+
+    @tf.function
+    def _read_fill(self):
+        fills = []
+        for shard, handle in enumerate(self._fill_handles):
+            with tf.device(self.cluster.get_device(self._module_name,
+                                                   shard)):
+                fills.append(tf.raw_ops.ReadVariableOp(
+                    resource=handle, dtype=tf.float64))
+        return tf.stack(fills)
+
+    def _shard_fill(self):
+        """
+        The [size, sampling mass] of every shard, or None if some shard
+        has not published them yet.
+        """
+        try:
+            return self._read_fill().numpy()
+        except (tf.errors.NotFoundError,
+                tf.errors.FailedPreconditionError):
+            return None
+
+    def pull(self, wait=True, return_data=False, timeout=None):
+        if self.shard_batches == 1 or not self._is_sink:
+            return super().pull(wait, return_data, timeout)
+
+        deadline = None if timeout is None or not wait \
+            else time.time() + timeout
+        interval = self.min_poll_interval
+
+        def expired():
+            return not wait or (deadline is not None and
+                                time.time() >= deadline)
+
+        # Split the batch over the shards in proportion to their mass,
+        # so the sharded batch follows the same distribution as one
+        # replay buffer holding everything.
+        fill = self._shard_fill()
+        while fill is None or fill[:, 1].sum() <= 0:
+            if expired():
+                print("No updates")
+                return None
+            time.sleep(interval)
+            interval = min(interval * 2, self.max_poll_interval)
+            fill = self._shard_fill()
+        counts = np.random.multinomial(
+            self.shard_batches, fill[:, 1] / fill[:, 1].sum())
+
+        # Only dequeue once every shard has its micro-batches ready, so
+        # a timeout never leaves a batch half pulled.
+        queues = dict(self._pull_queues())
+        shards = np.flatnonzero(counts)
+        while not all(self._update_queues[queues[s]].size() >= counts[s]
+                      for s in shards):
+            if expired():
+                print("No updates")
+                return None
+            time.sleep(interval)
+            interval = min(interval * 2, self.max_poll_interval)
+
+        # The dequeues are independent so they run on all shards at once
+        batches = list(self._dequeue_pool.map(
+            lambda s: self._update_queues[queues[s]].dequeue_many(
+                counts[s]), shards))
+        update = {k: tf.concat([
+            tf.reshape(b[k], [-1] + b[k].shape[2:].as_list())
+            for b in batches], axis=0) for k in batches[0]}
+        self._last_shards = np.repeat(shards, counts[shards])
+        self.last_source = None
+        if "probabilities" in update:
+            update["weights"] = self._global_weights(
+                update["probabilities"], np.repeat(
+                    fill[self._last_shards, 1] / fill[:, 1].sum(),
+                    self.micro_batch_size),
+                fill[:, 0].sum())
+        print("Pulled update")
+        if return_data:
+            return update
+        self._base_model.handle_data(update)
+
+    def _global_weights(self, probabilities, shard_share, size):
+        """
+        Importance weights of a sharded prioritized batch against the
+        whole replay, rather than against the shard of every slot.
+        """
+        probs = probabilities.numpy() * shard_share
+        weights = (size * probs) ** -self._base_model.beta
+        weights /= weights.max()
+        return tf.constant(weights, dtype=tf.float32)
+
+    def batch_origin(self):
+        """
+        Where the last batch pulled by the learner was sampled from,
+        for update_priorities() once more batches have been pulled.
+        """
+        return self.last_source, self._last_shards
+
+    def update_priorities(self, indices, priorities, origin=None):
+        """
+        Send new priorities for the slots of a batch pulled by the
+        learner back to the replay task(s) it was sampled from.
+
+        origin: the batch_origin() of the batch, defaults to the last
+                one pulled
+        """
+        assert self._priority_updates is not None, \
+            "The replay buffer does not support priorities"
+        last_source, last_shards = origin or self.batch_origin()
+        if last_shards is not None:
+            indices = np.reshape(indices, (self.shard_batches, -1))
+            priorities = np.reshape(priorities, (self.shard_batches, -1))
+            for i, shard in enumerate(last_shards):
+                self._priority_updates.push(
+                    {"indices": indices[i], "priorities": priorities[i]},
+                    force_ind=int(shard))
+            return
+        assert last_source is not None, "No batch has been pulled yet"
+        self._priority_updates.push(
+            {"indices": indices, "priorities": priorities},
+            force_ind=last_source)
+
+    def _apply_priority_updates(self):
+        if self._priority_updates is None:
+            return
+        for update in self._priority_updates.pull_ready().values():
+            with self._lock:
+                self._base_model.update_priorities(
+                    update["indices"].numpy(),
+                    update["priorities"].numpy())
+
+    def _ingest(self):
+        try:
+            while True:
+                data = self.pull_many(self.ingest_batch_size,
+                                      return_data=True)
+                if data is None:
+                    continue
+                with self._lock:
+                    self._base_model.handle_data(data)
+        except Exception as e:
+            # Surfaced by run() since this thread has no caller
+            self._ingest_error = e
+
+    def _fill_outbound(self):
+        """
+        Top up the queue to every learner to self.prefetch batches.
+        Returns whether any batch was pushed.
+        """
+        pushed = False
+        prefix = f"{self._module_name}OutboundTo{self._data_sink}"
+        for sink_ind in range(self._num_sinks):
+            queue = self._update_queues[f"{prefix}({self._index},{sink_ind})"]
+            while queue.size() < self.prefetch:
+                with self._lock:
+                    replay_sample = self._base_model.sample_n(
+                        self.micro_batch_size)
+                if replay_sample is None:
+                    return pushed
+                self.push(data=replay_sample, force_ind=sink_ind)
+                pushed = True
+        return pushed
+
+    def _maybe_snapshot(self):
+        if self._snapshot_dir is None or \
+           time.time() - self._last_snapshot < self.snapshot_interval:
+            return
+        thread = self._base_model._snapshot_thread
+        if thread is not None and thread.is_alive():
+            # Still writing the previous one
+            return
+        # Ingestion is only held up while a chunk of slots is copied,
+        # they are compressed and written on another thread.
+        self._base_model.snapshot(self._snapshot_dir, background=True,
+                                  lock=self._lock)
+        self._last_snapshot = time.time()
 
     def run(self):
+        # Ingesting worker data and serving batches run independently,
+        # so learners are never held up waiting for a new transition.
+        ingest = threading.Thread(target=self._ingest, daemon=True)
+        ingest.start()
 
         while True:
-            print("Waiting for data")
-            self.pull()
-            print("Got new data")
-            replay_sample = self._base_model.sample_n(
-                self.batch_size)
-            self.push(data=replay_sample)
-            print("Served a batch")
+            if self._ingest_error is not None:
+                raise self._ingest_error
+            self._apply_priority_updates()
+            if self.shard_batches > 1:
+                self._publish_fill()
+            self._maybe_snapshot()
+            if not self._fill_outbound():
+                time.sleep(0.001)
@@ -0,0 +1,187 @@
+import tensorflow as tf
+import numpy as np
+
+from dtf.replay_buffer.base_replay_buffer import ReplayBuffer
+
+class FrameReplayBuffer(ReplayBuffer):
+    """
+    A replay buffer which stores every observation once. Transitions
+    are linked to the slot holding the next observation of the same
+    stream (environment), and (observation, next_observation) pairs
+    are rebuilt at sample time, optionally stacking the last
+    frame_stack frames of the episode. This halves the memory and,
+    since next_observation is dropped from the queue spec, the bytes
+    sent from workers for image observations.
+
+    Terminal next observations are not stored: for transitions with
+    done set, next_observation is the same as observation, so the
+    learner has to mask the bootstrapped value with done.
+    """
+    def __init__(self, storage_spec, capacity, frame_stack=1,
+                 observation_key="observation",
+                 next_observation_key="next_observation",
+                 done_key="done", stream_key=None):
+        """
+        frame_stack: the number of consecutive frames returned for
+                     every observation, stacked along axis 1. Frames
+                     before the start of an episode repeat its first
+                     frame.
+        stream_key: an optional storage_spec key holding the id of the
+                    environment each transition came from. Without it
+                    the row of a transition within the batch passed to
+                    add() is used, which matches a vector_env.Env step.
+        """
+        self.frame_stack = frame_stack
+        self.observation_key = observation_key
+        self.next_observation_key = next_observation_key
+        self.done_key = done_key
+        self.stream_key = stream_key
+
+        storage_spec = dict(storage_spec)
+        storage_spec.pop(next_observation_key, None)
+        super().__init__(storage_spec, capacity)
+
+        self._reset_links()
+
+    def _reset_links(self):
+        # _next[t] is the slot holding the observation after slot t,
+        # _prev[t] the slot holding the one before it in the episode.
+        self._next = np.full(self.capacity, -1, dtype=np.int64)
+        self._prev = np.full(self.capacity, -1, dtype=np.int64)
+        self._done = np.zeros(self.capacity, dtype=bool)
+        # Bumped on every write so stale links can be detected
+        self._generation = np.zeros(self.capacity, dtype=np.int64)
+        # stream id -> (slot, generation) still waiting for its next
+        # observation
+        self._pending = {}
+
+    def clear(self):
+        super().clear()
+        self._reset_links()
+
+    def _snapshot_state(self):
+        state = super()._snapshot_state()
+        state["next"] = self._next.copy()
+        state["prev"] = self._prev.copy()
+        state["done"] = self._done.copy()
+        state["generation"] = self._generation.copy()
+        pending = list(self._pending.items())
+        state["pending_streams"] = np.array([s for s, _ in pending])
+        state["pending_slots"] = np.array(
+            [slot for _, (slot, _) in pending], dtype=np.int64)
+        state["pending_generations"] = np.array(
+            [g for _, (_, g) in pending], dtype=np.int64)
+        return state
+
+    def _restore_state(self, state):
+        super()._restore_state(state)
+        self._next[:] = state["next"]
+        self._prev[:] = state["prev"]
+        self._done[:] = state["done"]
+        self._generation[:] = state["generation"]
+        self._pending = {
+            stream: (slot, generation) for stream, slot, generation in zip(
+                state["pending_streams"].tolist(),
+                state["pending_slots"], state["pending_generations"])}
+
+    @property
+    def sample_spec(self):
+        shape = self.storage_shapes[self.observation_key]
+        if self.frame_stack > 1:
+            shape = (self.frame_stack, *shape)
+        dtype = self.storage_dtypes[self.observation_key]
+        return {
+            self.observation_key: (shape, dtype),
+            self.next_observation_key: (shape, dtype),
+        }
+
+    def get_scatter_indices(self, n):
+        idx = super().get_scatter_indices(n)
+
+        # Break every link into the slots which are being overwritten
+        nxt = self._next[idx]
+        nxt = nxt[nxt >= 0]
+        self._prev[nxt[np.isin(self._prev[nxt], idx)]] = -1
+        prv = self._prev[idx]
+        prv = prv[prv >= 0]
+        self._next[prv[np.isin(self._next[prv], idx)]] = -1
+
+        self._next[idx] = -1
+        self._prev[idx] = -1
+        self._generation[idx] += 1
+        return idx
+
+    def add(self, to_add):
+        to_add = dict(to_add)
+        to_add.pop(self.next_observation_key, None)
+
+        done = np.asarray(to_add[self.done_key]).astype(bool).reshape(-1)
+        if self.stream_key is not None:
+            streams = np.asarray(to_add[self.stream_key]).reshape(-1)
+        else:
+            streams = np.arange(len(done))
+
+        idx = super().add(to_add)
+
+        # Oversized batches only keep their last capacity rows
+        done = done[-len(idx):]
+        streams = streams[-len(idx):]
+        self._done[idx] = done
+        for slot, stream, slot_done in zip(idx, streams.tolist(), done):
+            if stream in self._pending:
+                prev, generation = self._pending.pop(stream)
+                if self._generation[prev] == generation:
+                    self._next[prev] = slot
+                    self._prev[slot] = prev
+            if not slot_done:
+                self._pending[stream] = (slot, self._generation[slot])
+        return idx
+
+    def _valid(self, idx):
+        return self._done[idx] | (self._next[idx] >= 0)
+
+    def _stack(self, idx):
+        frames = [idx]
+        for _ in range(self.frame_stack - 1):
+            prev = self._prev[frames[0]]
+            frames.insert(0, np.where(prev >= 0, prev, frames[0]))
+        return np.stack(frames, axis=1)
+
+    def _read_frames(self, idx):
+        frames = self._stack(idx)
+        obs = self._read(self.observation_key, frames.reshape(-1))
+        shape = self.storage_shapes[self.observation_key]
+        if self.frame_stack > 1:
+            return tf.reshape(obs, (len(idx), self.frame_stack, *shape))
+        return tf.reshape(obs, (len(idx), *shape))
+
+    def sample_n(self, n):
+        if self.size == -1:
+            return None
+        if self.size < n:
+            print("WARNING: sampling a larger batch than we have samples")
+
+        # Only the last transition of every stream is still waiting for
+        # its next observation, so rejection sampling converges fast.
+        idx = np.random.randint(0, self.size, size=n)
+        invalid = ~self._valid(idx)
+        for _ in range(100):
+            if not invalid.any():
+                break
+            idx[invalid] = np.random.randint(
+                0, self.size, size=invalid.sum())
+            invalid = ~self._valid(idx)
+        else:
+            valid = np.flatnonzero(self._valid(np.arange(self.size)))
+            if len(valid) == 0:
+                return None
+            idx = valid[np.random.randint(0, len(valid), size=n)]
+        next_idx = np.where(self._done[idx], idx, self._next[idx])
+
+        ret = {}
+        for k in self.storage:
+            if k != self.observation_key:
+                ret[k] = self._read(k, idx)
+        ret[self.observation_key] = self._read_frames(idx)
+        ret[self.next_observation_key] = self._read_frames(next_idx)
+        return ret
@@ -0,0 +1,96 @@
+import tensorflow as tf
+import numpy as np
+import os
+import shutil
+import tempfile
+import weakref
+
+from dtf.replay_buffer.base_replay_buffer import ReplayBuffer
+
+class MemmapReplayBuffer(ReplayBuffer):
+    """
+    A replay buffer which keeps every storage_spec key in a np.memmap
+    file on local disk rather than in memory, so the buffer can be
+    larger than RAM. The fill level is kept in a small memmapped file
+    next to the data, so a replay task restarted with the same
+    directory picks up where it left off instead of refilling.
+    """
+    def __init__(self, storage_spec, capacity, directory=None):
+        """
+        directory: where the buffer files are kept. If it already holds
+                   a buffer with the same spec and capacity it is
+                   reopened, otherwise new files are created. Defaults
+                   to a fresh temporary directory, which is removed
+                   with the buffer.
+        """
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix="dtf_replay_")
+            weakref.finalize(self, shutil.rmtree, directory, True)
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+        super().__init__(storage_spec, capacity)
+
+        # [size, cursor]
+        self._meta = self._open(
+            "meta", (2,), np.int64, fill=[-1, 0])
+        self.size, self._cursor = (int(v) for v in self._meta)
+
+    def _open(self, name, shape, dtype, fill=None):
+        path = os.path.join(self.directory, f"{name}.dat")
+        if os.path.exists(path):
+            mode = "r+"
+            expected = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            assert os.path.getsize(path) == expected, \
+                f"{path} does not match the requested spec and capacity"
+        else:
+            mode = "w+"
+        array = np.memmap(path, dtype=dtype, mode=mode, shape=shape)
+        if mode == "w+" and fill is not None:
+            array[:] = fill
+        return array
+
+    def _make_storage(self):
+        storage = {}
+        for k, shape in self.storage_shapes.items():
+            storage[k] = self._open(
+                k, (self.capacity, *shape),
+                self.storage_dtypes[k].as_numpy_dtype)
+        return storage
+
+    def _read(self, k, idx):
+        return tf.constant(self.storage[k][idx])
+
+    def _write(self, k, idx, values):
+        self._touch(idx)
+        self.storage[k][idx] = np.asarray(values).astype(
+            self.storage[k].dtype, copy=False)
+
+    def _snapshot_chunk(self, idx):
+        # Read straight from the files, without a tf copy
+        return {k: v[idx] for k, v in self.storage.items()}
+
+    def _save_meta(self):
+        self._meta[:] = [self.size, self._cursor]
+
+    def clear(self):
+        super().clear()
+        self._save_meta()
+
+    def _restore_state(self, state):
+        super()._restore_state(state)
+        self._save_meta()
+
+    def add(self, to_add):
+        idx = super().add(to_add)
+        # Only record the new fill level once the data is written
+        self._save_meta()
+        return idx
+
+    def flush(self):
+        """
+        Write any dirty pages out to disk.
+        """
+        for array in self.storage.values():
+            array.flush()
+        self._meta.flush()
@@ -0,0 +1,97 @@
+import tensorflow as tf
+import numpy as np
+
+from dtf.replay_buffer.base_replay_buffer import ReplayBuffer
+from dtf.replay_buffer.sum_tree import SumTree
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """
+    A replay buffer which samples transitions proportionally to their
+    priority (usually the TD error) instead of uniformly. New
+    transitions get the largest priority seen so far so they are
+    sampled at least once.
+
+    sample_n() additionally returns the sampled slots under "indices",
+    their importance sampling weights under "weights" and the
+    probability they were sampled with under "probabilities". The learner
+    sends new priorities for those slots back with update_priorities().
+    """
+    def __init__(self, storage_spec, capacity,
+                 alpha=0.6, beta=0.4, epsilon=1e-6):
+        """
+        alpha: how strongly priorities skew sampling, 0 is uniform
+        beta: how strongly the importance weights correct for the skew,
+              1 corrects fully
+        epsilon: added to every priority so no transition is starved
+        """
+        super().__init__(storage_spec, capacity)
+        self.alpha = alpha
+        self.beta = beta
+        self.epsilon = epsilon
+
+        self._tree = SumTree(capacity)
+        self._max_priority = 1.0
+
+    def clear(self):
+        super().clear()
+        self._tree = SumTree(self.capacity)
+        self._max_priority = 1.0
+
+    @property
+    def sample_spec(self):
+        return {
+            "indices": ((), tf.int64),
+            "weights": ((), tf.float32),
+            "probabilities": ((), tf.float32),
+        }
+
+    @property
+    def sampling_mass(self):
+        return self._tree.total if self.size > 0 else 0.
+
+    def _snapshot_state(self):
+        state = super()._snapshot_state()
+        state["tree"] = self._tree._tree.copy()
+        state["max_priority"] = np.float64(self._max_priority)
+        return state
+
+    def _restore_state(self, state):
+        super()._restore_state(state)
+        self._tree._tree[:] = state["tree"]
+        self._max_priority = float(state["max_priority"])
+
+    def add(self, to_add):
+        idx = super().add(to_add)
+        self._tree.update(idx, self._max_priority ** self.alpha)
+        return idx
+
+    def sample_n(self, n):
+        if self.size == -1:
+            return None
+        if self.size < n:
+            print("WARNING: sampling a larger batch than we have samples")
+
+        # Stratified sampling, one target per equal slice of the total
+        segment = self._tree.total / n
+        targets = (np.arange(n) + np.random.uniform(size=n)) * segment
+        idx = np.minimum(self._tree.find(targets), self.size - 1)
+
+        probs = self._tree.get(idx) / self._tree.total
+        weights = (self.size * probs) ** -self.beta
+        weights /= weights.max()
+
+        ret = {}
+        for k in self.storage:
+            ret[k] = self._read(k, idx)
+        ret["indices"] = tf.constant(idx, dtype=tf.int64)
+        ret["weights"] = tf.constant(weights, dtype=tf.float32)
+        ret["probabilities"] = tf.constant(probs, dtype=tf.float32)
+        return ret
+
+    def update_priorities(self, indices, priorities):
+        indices = np.asarray(indices, dtype=np.int64)
+        priorities = np.abs(np.asarray(priorities, dtype=np.float64))
+        priorities += self.epsilon
+
+        self._max_priority = max(self._max_priority, priorities.max())
+        self._tree.update(indices, priorities ** self.alpha)
@@ -0,0 +1,228 @@
+import tensorflow as tf
+import numpy as np
+
+from dtf.replay_buffer.base_replay_buffer import ReplayBuffer
+
+class SequenceReplayBuffer(ReplayBuffer):
+    """
+    A replay buffer which keeps the transitions of every stream
+    (environment) contiguous in its own ring of capacity // num_streams
+    slots and samples fixed length sequences which never cross an
+    episode boundary. Every stored key comes back with shape
+    (batch, sequence_length, ...).
+
+    n-step returns are accumulated as transitions arrive, so sampling
+    only reads them: "nstep_return" is the discounted sum of the next
+    n_step rewards of the episode and "nstep_discount" is gamma ** n_step,
+    or 0 when the episode ended within those steps. If next_observation
+    is stored "nstep_next_observation" is the observation to bootstrap
+    from.
+    """
+    def __init__(self, storage_spec, capacity, sequence_length=1,
+                 n_step=1, gamma=0.99, num_streams=1,
+                 reward_key="reward", done_key="done",
+                 next_observation_key="next_observation",
+                 stream_key=None):
+        """
+        sequence_length: the number of consecutive transitions in every
+                         sampled sequence
+        n_step: the number of rewards summed into nstep_return
+        gamma: the discount of the n-step returns
+        num_streams: the number of environments feeding the buffer,
+                     each gets capacity // num_streams slots
+        stream_key: an optional storage_spec key holding the id of the
+                    environment, in [0, num_streams), each transition
+                    came from. Without it the row of a transition within
+                    the batch passed to add() is used, which matches a
+                    vector_env.Env step. Needed in a distributed replay,
+                    where rows from different workers are mixed.
+        """
+        assert capacity // num_streams >= sequence_length, \
+            "Every stream needs room for at least one sequence"
+        self.sequence_length = sequence_length
+        self.n_step = n_step
+        self.gamma = gamma
+        self.num_streams = num_streams
+        self.reward_key = reward_key
+        self.done_key = done_key
+        self.next_observation_key = next_observation_key
+        self.stream_key = stream_key
+        self._stream_capacity = capacity // num_streams
+        super().__init__(storage_spec, capacity)
+
+        self._reset_streams()
+
+    def _reset_streams(self):
+        # The number of transitions written to every stream so far
+        self._steps = np.zeros(self.num_streams, dtype=np.int64)
+        self._episodes = np.zeros(self.num_streams, dtype=np.int64)
+        # Per slot: the step of its stream it holds (-1 when empty), its
+        # episode and its n-step return so far
+        self._time = np.full(self.capacity, -1, dtype=np.int64)
+        self._episode = np.zeros(self.capacity, dtype=np.int64)
+        self._return = np.zeros(self.capacity, dtype=np.float32)
+        self._discount = np.ones(self.capacity, dtype=np.float32)
+        # Whether all n_step rewards, or the end of the episode, have
+        # been added to the return
+        self._closed = np.zeros(self.capacity, dtype=bool)
+        # The last slot whose reward went into the return
+        self._bootstrap = np.zeros(self.capacity, dtype=np.int64)
+
+    def clear(self):
+        super().clear()
+        self._reset_streams()
+
+    # Per stream and per slot bookkeeping saved with every snapshot
+    _STATE = ("_steps", "_episodes", "_time", "_episode", "_return",
+              "_discount", "_closed", "_bootstrap")
+
+    def _snapshot_state(self):
+        state = super()._snapshot_state()
+        for name in self._STATE:
+            state[name] = getattr(self, name).copy()
+        return state
+
+    def _restore_state(self, state):
+        super()._restore_state(state)
+        for name in self._STATE:
+            getattr(self, name)[:] = state[name]
+
+    @property
+    def sample_spec(self):
+        spec = {}
+        for k, shape in self.storage_shapes.items():
+            spec[k] = ((self.sequence_length, *shape),
+                       self.storage_dtypes[k])
+        spec["nstep_return"] = ((self.sequence_length,), tf.float32)
+        spec["nstep_discount"] = ((self.sequence_length,), tf.float32)
+        if self.next_observation_key in self.storage_shapes:
+            spec["nstep_next_observation"] = \
+                spec[self.next_observation_key]
+        return spec
+
+    def _slot(self, streams, steps):
+        return streams * self._stream_capacity + \
+            steps % self._stream_capacity
+
+    def add(self, to_add):
+        done = np.asarray(to_add[self.done_key]).astype(bool).reshape(-1)
+        reward = np.asarray(
+            to_add[self.reward_key], dtype=np.float32).reshape(-1)
+        if self.stream_key is not None:
+            streams = np.asarray(
+                to_add[self.stream_key]).astype(np.int64).reshape(-1)
+        else:
+            streams = np.arange(len(done))
+        assert np.all((streams >= 0) & (streams < self.num_streams)), \
+            "Stream ids have to be in [0, num_streams)"
+
+        # A stream can show up more than once in a batch, process its
+        # transitions in order, one occurrence of every stream at a time.
+        order = np.argsort(streams, kind="stable")
+        occurrence = np.empty(len(streams), dtype=np.int64)
+        _, starts, counts = np.unique(
+            streams[order], return_index=True, return_counts=True)
+        occurrence[order] = np.arange(len(streams)) - \
+            np.repeat(starts, counts)
+        assert counts.max() <= self._stream_capacity, \
+            "More transitions of one stream than it has slots"
+
+        idx = np.empty(len(streams), dtype=np.int64)
+        for i in range(occurrence.max() + 1):
+            rows = np.flatnonzero(occurrence == i)
+            idx[rows] = self._insert(
+                streams[rows], reward[rows], done[rows])
+
+        for k in self.storage:
+            assert k in to_add, f"You are missing {k} in your data"
+            values = np.reshape(np.asarray(to_add[k]),
+                                (-1, *self.storage_shapes[k]))
+            self._write(k, idx, values)
+
+        return idx
+
+    def _insert(self, streams, reward, done):
+        """
+        Place one transition of every stream in streams and add its
+        reward to the returns of the last n_step transitions.
+        """
+        steps = self._steps[streams]
+        slots = self._slot(streams, steps)
+        self.size = max(self.size, 0) + int(np.sum(self._time[slots] < 0))
+        self._time[slots] = steps
+        self._episode[slots] = self._episodes[streams]
+        self._return[slots] = 0.
+        self._discount[slots] = 1.
+        self._closed[slots] = False
+
+        for k in range(self.n_step):
+            prev_steps = steps - k
+            prev = self._slot(streams, prev_steps)
+            open_ = (prev_steps >= 0) & (self._time[prev] == prev_steps) & \
+                (self._episode[prev] == self._episodes[streams]) & \
+                ~self._closed[prev]
+            prev = prev[open_]
+            self._return[prev] += self._discount[prev] * reward[open_]
+            self._discount[prev] *= self.gamma
+            self._bootstrap[prev] = slots[open_]
+            if k == self.n_step - 1:
+                self._closed[prev] = True
+            # Nothing after the end of an episode is bootstrapped
+            ended = prev[done[open_]]
+            self._discount[ended] = 0.
+            self._closed[ended] = True
+
+        self._steps[streams] += 1
+        self._episodes[streams] += done
+        return slots
+
+    def _valid(self, slots):
+        streams = slots // self._stream_capacity
+        start = self._time[slots]
+        end = self._slot(streams, start + self.sequence_length - 1)
+        return (start >= 0) & \
+            (start + self.sequence_length <= self._steps[streams]) & \
+            (self._episode[end] == self._episode[slots]) & \
+            self._closed[end]
+
+    def sample_n(self, n):
+        if self.size == -1:
+            return None
+
+        filled = np.flatnonzero(self._time >= 0)
+        if len(filled) == 0:
+            return None
+        # Only the last few transitions of every stream can not start a
+        # sequence, so rejection sampling converges fast.
+        start = filled[np.random.randint(0, len(filled), size=n)]
+        invalid = ~self._valid(start)
+        for _ in range(100):
+            if not invalid.any():
+                break
+            start[invalid] = filled[np.random.randint(
+                0, len(filled), size=invalid.sum())]
+            invalid = ~self._valid(start)
+        else:
+            valid = filled[self._valid(filled)]
+            if len(valid) == 0:
+                return None
+            start = valid[np.random.randint(0, len(valid), size=n)]
+
+        streams = start // self._stream_capacity
+        steps = self._time[start][:, None] + np.arange(self.sequence_length)
+        idx = self._slot(streams[:, None], steps).reshape(-1)
+
+        ret = {}
+        for k in self.storage:
+            values = self._read(k, idx)
+            ret[k] = tf.reshape(
+                values, (n, self.sequence_length, *self.storage_shapes[k]))
+        shape = (n, self.sequence_length)
+        ret["nstep_return"] = tf.constant(self._return[idx].reshape(shape))
+        ret["nstep_discount"] = tf.constant(
+            self._discount[idx].reshape(shape))
+        if self.next_observation_key in self.storage:
+            ret["nstep_next_observation"] = tf.reshape(
+                self._read(self.next_observation_key, self._bootstrap[idx]),
+                ret[self.next_observation_key].shape)
+        return ret
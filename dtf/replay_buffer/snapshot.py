@@ -0,0 +1,156 @@
+import numpy as np
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Lists the snapshots a restore replays, in order, starting with the
+# last full one. Rewritten atomically once a snapshot is on disk, so a
+# crash mid snapshot leaves the previous one intact.
+MANIFEST = "manifest.json"
+
+def _chunk_path(directory, number, chunk):
+    return os.path.join(directory, f"{number:06d}-{chunk:05d}.npz")
+
+def _state_path(directory, number):
+    return os.path.join(directory, f"{number:06d}-state.npz")
+
+def read_manifest(directory):
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+class Snapshot:
+    """
+    One snapshot of a replay buffer being written. The slots are read
+    and written one chunk at a time, so only a chunk is ever held in
+    memory and the buffer is only held up while a chunk is copied.
+
+    The snapshot is of the buffer as it was when the slots were picked:
+    the buffer calls preserve() before overwriting a slot, which keeps
+    the old row of any slot not copied yet.
+    """
+    def __init__(self, directory, number, full, idx, state, read_chunk,
+                 capacity, chunk_size, lock):
+        """
+        number: the position of the snapshot in the directory
+        full: whether idx covers the whole buffer, so every earlier
+              snapshot can be dropped
+        idx: the slots written since the previous snapshot
+        state: a dict of arrays taken along with idx, which is saved
+               whole
+        read_chunk: returns a dict mapping storage keys to a copy of
+                    the values of the slots it is given
+        capacity: the number of slots in the buffer
+        chunk_size: the most slots stored per file
+        lock: held while reading from the buffer
+        """
+        self.directory = directory
+        self.number = number
+        self.full = full
+        self.idx = idx
+        self.state = state
+        self.read_chunk = read_chunk
+        self.chunk_size = chunk_size
+        self.lock = lock
+
+        # Slots still to be copied, and the rows kept for those of them
+        # which were overwritten in the meantime
+        self._remaining = np.zeros(capacity, dtype=bool)
+        self._remaining[idx] = True
+        self._preserved = {}
+
+    def preserve(self, idx):
+        """
+        Keep the current rows of the slots in idx which are still to
+        be copied. Called with the lock held, before idx is written.
+        """
+        idx = np.unique(idx[self._remaining[idx]])
+        if len(idx) == 0:
+            return
+        rows = self.read_chunk(idx)
+        for i, slot in enumerate(idx.tolist()):
+            self._preserved[slot] = {k: v[i] for k, v in rows.items()}
+        self._remaining[idx] = False
+
+    def _copy_chunk(self, idx):
+        with self.lock:
+            chunk = self.read_chunk(idx)
+            self._remaining[idx] = False
+            preserved = [(i, self._preserved.pop(slot))
+                         for i, slot in enumerate(idx.tolist())
+                         if slot in self._preserved]
+        if preserved:
+            chunk = {k: np.array(v) for k, v in chunk.items()}
+            for i, rows in preserved:
+                for k, row in rows.items():
+                    chunk[k][i] = row
+        return chunk
+
+    def write(self):
+        os.makedirs(self.directory, exist_ok=True)
+        num_chunks = 0
+        for start in range(0, len(self.idx), self.chunk_size):
+            idx = self.idx[start:start + self.chunk_size]
+            chunk = self._copy_chunk(idx)
+            np.savez_compressed(
+                _chunk_path(self.directory, self.number, num_chunks),
+                idx=idx, **chunk)
+            num_chunks += 1
+        np.savez_compressed(
+            _state_path(self.directory, self.number), **self.state)
+
+        manifest = read_manifest(self.directory)
+        old_chunks, old_states = [], []
+        if manifest is not None:
+            # Only the state of the last snapshot is ever read
+            old_states = [n for n, _ in manifest["snapshots"]]
+        if self.full or manifest is None:
+            if manifest is not None:
+                old_chunks = manifest["snapshots"]
+            manifest = {"snapshots": [], "rows": 0}
+        manifest["snapshots"].append([self.number, num_chunks])
+        if not self.full:
+            manifest["rows"] += len(self.idx)
+        tmp = os.path.join(self.directory, MANIFEST + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, os.path.join(self.directory, MANIFEST))
+
+        # Only drop what the new manifest no longer refers to
+        for number, chunks in old_chunks:
+            for chunk in range(chunks):
+                os.remove(_chunk_path(self.directory, number, chunk))
+        for number in old_states:
+            path = _state_path(self.directory, number)
+            if os.path.exists(path):
+                os.remove(path)
+
+def _load(path):
+    with np.load(path) as data:
+        return {k: data[k] for k in data.files}
+
+def read_snapshots(directory, num_threads=8):
+    """
+    Load the snapshots listed in the manifest of directory. The chunks
+    are decompressed on num_threads threads.
+
+    Returns the manifest, a list with the (idx, rows) of every chunk
+    in the order they have to be written back, and the state of the
+    last snapshot. Returns None if directory holds no snapshot.
+    """
+    manifest = read_manifest(directory)
+    if manifest is None:
+        return None
+    paths = [_chunk_path(directory, number, chunk)
+             for number, chunks in manifest["snapshots"]
+             for chunk in range(chunks)]
+    last = manifest["snapshots"][-1][0]
+    with ThreadPoolExecutor(num_threads) as pool:
+        state = pool.submit(_load, _state_path(directory, last))
+        chunks = []
+        for data in pool.map(_load, paths):
+            idx = data.pop("idx")
+            chunks.append((idx, data))
+        return manifest, chunks, state.result()
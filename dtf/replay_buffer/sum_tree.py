@@ -0,0 +1,60 @@
+import numpy as np
+
+class SumTree:
+    """
+    An array backed binary tree where every node holds the sum of its
+    children. Leaves hold the priorities of the replay slots, so
+    sampling proportionally to priority and updating priorities are
+    both O(log N) per item, and both operate on whole batches at once.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+
+        # Round up to a power of two so every leaf sits at the same
+        # depth and the tree can be walked level by level.
+        self._num_leaves = 1
+        while self._num_leaves < capacity:
+            self._num_leaves *= 2
+        self._depth = int(np.log2(self._num_leaves))
+
+        # Node 1 is the root, the children of node i are 2i and 2i + 1
+        # and the leaves start at self._num_leaves.
+        self._tree = np.zeros(2 * self._num_leaves, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self._tree[1]
+
+    def get(self, idx):
+        return self._tree[np.asarray(idx) + self._num_leaves]
+
+    def update(self, idx, priorities):
+        """
+        Set the priorities of the slots in idx. If idx contains
+        duplicates the last priority wins.
+        """
+        nodes = np.asarray(idx, dtype=np.int64) + self._num_leaves
+        self._tree[nodes] = priorities
+
+        for _ in range(self._depth):
+            nodes = np.unique(nodes // 2)
+            self._tree[nodes] = (self._tree[2 * nodes] +
+                                 self._tree[2 * nodes + 1])
+
+    def find(self, targets):
+        """
+        For every target in [0, total) return the slot whose
+        cumulative priority range contains it.
+        """
+        targets = np.array(targets, dtype=np.float64)
+        nodes = np.ones(targets.shape, dtype=np.int64)
+
+        for _ in range(self._depth):
+            left = 2 * nodes
+            go_right = targets >= self._tree[left]
+            targets -= self._tree[left] * go_right
+            nodes = left + go_right
+
+        # Floating point error can push a target into an empty leaf past
+        # the end of the buffer.
+        return np.minimum(nodes - self._num_leaves, self.capacity - 1)
@@ -1,7 +1,9 @@
 import tensorflow as tf
 
 from dtf.environment import Env
+from dtf.inference import InferenceServer
 from dtf.modules import DistributedModel, Model, DistributedModule
+from dtf.modules import ParameterServerModule
 from dtf.replay_buffer import get_replay_buffer, DistributedRelayBuffer
 
 class Worker:
@@ -10,7 +12,8 @@ class Worker:
                  model_cls, replay_buffer_spec,
                  learner_spec,
                  cluster=None, task=None,
-                 task_index=None, distributed=False):
+                 task_index=None, distributed=False,
+                 inference_spec=None):
         self._env_name = env_name
         self._num_envs = num_envs
         self._cluster = cluster
@@ -21,22 +24,58 @@ class Worker:
         self._model_cls = model_cls
         self._replay_buffer_spec = replay_buffer_spec
         self._learner_spec = learner_spec
+        self._inference_spec = inference_spec
 
         self._setup()
 
     def _setup(self):
-        self._env = Env(self._env_name, self._num_envs)
+        # Every worker numbers its environments after the previous
+        # worker's, so the replay can keep their transitions apart.
+        self._env = Env(self._env_name, self._num_envs,
+                        stream_offset=(self._task_index or 0) *
+                        self._num_envs)
 
         self._model = self._model_cls(
             self._env.storage_spec)
 
-        if self._distributed:
-            self._model = DistributedModule(
-                self._model, data_source="learner",
-                data_sink=None, cluster=self._cluster,
-                module_name="worker", task=self._task,
-                index=self._task_index,
+        if self._distributed and self._inference_spec:
+            self._model = InferenceServer(
+                self._model,
+                self._env.observation_space.shape,
+                self._env.action_space.shape,
+                self._num_envs,
+                self._inference_spec["max_batch_size"],
+                self._inference_spec["max_latency"],
+                worker_name="worker",
+                learner_name="learner",
+                server_name="inference",
+                task_name=self._task,
+                task_index=self._task_index,
+                cluster=self._cluster,
             )
+        elif self._distributed:
+            if self._learner_spec.get("parameter_server"):
+                # The weights are sharded over a ps job instead of being
+                # queued to every worker
+                self._model = ParameterServerModule(
+                    self._model,
+                    ps_name=self._learner_spec["parameter_server"],
+                    data_source="learner", cluster=self._cluster,
+                    module_name="worker", task=self._task,
+                    index=self._task_index,
+                )
+            else:
+                self._model = DistributedModule(
+                    self._model, data_source="learner",
+                    data_sink=None, cluster=self._cluster,
+                    module_name="worker", task=self._task,
+                    index=self._task_index, push_to_all=True,
+                    versioned=True,
+                    update_codec=self._learner_spec.get("update_codec"),
+                    keyframe_interval=self._learner_spec.get(
+                        "keyframe_interval", 10),
+                    fanout=self._learner_spec.get("fanout"),
+                )
             self._replay_buffer = DistributedRelayBuffer(
                 self._replay_buffer_spec["type"],
                 self._env.storage_spec,
@@ -48,12 +87,31 @@ class Worker:
                 task_name=self._task,
                 task_index=self._task_index,
                 cluster=self._cluster,
+                replay_buffer_kwargs=self._replay_buffer_spec.get(
+                    "kwargs"),
+                # The queue layout has to match on every task
+                inbound_size=self._replay_buffer_spec.get(
+                    "inbound_size", 0),
+                inbound_capacity=self._replay_buffer_spec.get(
+                    "inbound_capacity", 10),
+                outbound_capacity=self._replay_buffer_spec.get(
+                    "outbound_capacity", 10),
+                max_queue_bytes=self._replay_buffer_spec.get(
+                    "max_queue_bytes"),
+                shard_batches=self._replay_buffer_spec.get(
+                    "shard_batches", 1),
+                routing=self._replay_buffer_spec.get("routing", "random"),
+                staging_capacity=self._replay_buffer_spec.get(
+                    "staging_capacity", 0),
+                staging_overflow=self._replay_buffer_spec.get(
+                    "staging_overflow", "drop_oldest"),
             )
         else:
             self._replay_buffer = get_replay_buffer(
                 self._replay_buffer_spec["type"])(
                     self._env.storage_spec,
-                    self._replay_buffer_spec["capacity"]
+                    self._replay_buffer_spec["capacity"],
+                    **self._replay_buffer_spec.get("kwargs", {})
                 )
 
     def run(self):
@@ -68,6 +126,6 @@ class Worker:
                 replay_data = self._env.step(action.numpy())
                 done = replay_data["done"]
 
-                self._replay_buffer.push(replay_data)
+                self._replay_buffer.add(replay_data)
 
             self._model.maybe_pull()
@@ -3,7 +3,7 @@ import tensorflow as tf
 import multiprocessing
 import time
 from dtf.cluster import Cluster
-from dtf.modules import DistributedModule, DistributedModel
+from dtf.modules import DistributedModule, DistributedModel, QueueModule
 import numpy as np
 
 from test_utils import wait_for_shutdown
@@ -146,6 +146,235 @@ def test_chain_fn(args):
         assert model(5.0) == 5.0
         wait_for_shutdown(model)
 
+def test_pull_many_fn(args):
+    cluster_dict, task, task_idx = args
+
+    clus = Cluster(cluster_dict, task, task_idx)
+    clus.start()
+
+    model = QueueModule({"x": [1]},
+                        cluster=clus,
+                        data_source="learner",
+                        module_name="worker",
+                        task=task,
+                        index=task_idx)
+
+    if task == "learner":
+        for i in range(3):
+            model.push({"x": [float(task_idx)]})
+        wait_for_shutdown(model)
+    else:
+        while sum(int(q.size()) for q in model._update_queues.values()) < 6:
+            time.sleep(0.1)
+        first = model.pull_many(4, return_data=True)
+        assert first["x"].shape == (4, 1)
+        second = model.pull_many(4, return_data=True)
+        assert second["x"].shape == (2, 1)
+        values = np.concatenate([first["x"], second["x"]])[:, 0]
+        assert sorted(values.tolist()) == [0., 0., 0., 1., 1., 1.]
+        assert model.pull_many(4, wait=False, return_data=True) is None
+        start = time.time()
+        assert model.wait_for_update(timeout=0.2) is None
+        assert model.pull(return_data=True, timeout=0.2) is None
+        assert time.time() - start < 1.
+        wait_for_shutdown(model)
+
+def test_versioned_fn(args):
+    cluster_dict, task, task_idx, compile_push = args
+
+    clus = Cluster(cluster_dict, task, task_idx)
+    clus.start()
+
+    model = DistributedModule(DummyModel(),
+                              cluster=clus,
+                              data_source="learner",
+                              module_name="worker",
+                              task=task,
+                              index=task_idx,
+                              push_to_all=True,
+                              versioned=True,
+                              compile_push=compile_push)
+
+    if task == "learner":
+        for i in range(3):
+            model._base_model.v.assign(float(i + 1))
+            model.push()
+        assert model.version == 3
+        wait_for_shutdown(model)
+    else:
+        queue = model._update_queues[model._pull_queues()[0][1]]
+        while queue.size() < 3:
+            time.sleep(0.1)
+        model.pull()
+        # Only the newest snapshot is applied
+        assert model(5.0) == 15.0
+        assert model.version == 3
+        assert queue.size() == 0
+        wait_for_shutdown(model)
+
+def test_versioned_full_fn(args):
+    cluster_dict, task, task_idx, compile_push = args
+
+    clus = Cluster(cluster_dict, task, task_idx)
+    clus.start()
+
+    model = DistributedModule(DummyModel(),
+                              cluster=clus,
+                              data_source="learner",
+                              module_name="worker",
+                              task=task,
+                              index=task_idx,
+                              push_to_all=True,
+                              versioned=True,
+                              inbound_capacity=2,
+                              compile_push=compile_push)
+
+    if task == "learner":
+        # Nobody pulls, the pushes past the capacity are skipped
+        # instead of blocking.
+        for i in range(4):
+            model._base_model.v.assign(float(i + 1))
+            model.push()
+        assert model.version == 4
+        wait_for_shutdown(model)
+    else:
+        queue = model._update_queues[model._pull_queues()[0][1]]
+        while queue.size() < 2:
+            time.sleep(0.1)
+        time.sleep(0.5)
+        assert queue.size() == 2
+        model.pull()
+        assert model(5.0) == 10.0
+        assert model.version == 2
+        wait_for_shutdown(model)
+
+def test_update_codec_fn(args):
+    cluster_dict, task, task_idx, codec = args
+
+    clus = Cluster(cluster_dict, task, task_idx)
+    clus.start()
+
+    model = DistributedModule(DummyModel(),
+                              cluster=clus,
+                              data_source="learner",
+                              module_name="worker",
+                              task=task,
+                              index=task_idx,
+                              push_to_all=True,
+                              update_codec=codec,
+                              keyframe_interval=3)
+
+    if task == "learner":
+        # A keyframe followed by two deltas against it
+        for v in [1.0, 1.5, 0.75]:
+            model._base_model.v.assign(v)
+            model.push()
+        wait_for_shutdown(model)
+    else:
+        name = model._pull_queues()[0][1]
+        queue = model._update_queues[name]
+        assert queue.dtypes[0] == tf.as_dtype(codec)
+        while queue.size() < 2:
+            time.sleep(0.1)
+        model.pull()
+        assert model.version == 3
+        assert np.isclose(model(1.0), 0.75, atol=1e-2)
+        assert model._update_queues[name + "Keyframe"].size() == 0
+        wait_for_shutdown(model)
+
+def test_relay_fn(args):
+    cluster_dict, task, task_idx = args
+
+    clus = Cluster(cluster_dict, task, task_idx)
+    clus.start()
+
+    model = DistributedModule(DummyModel(),
+                              cluster=clus,
+                              data_source="learner",
+                              module_name="worker",
+                              task=task,
+                              index=task_idx,
+                              push_to_all=True,
+                              versioned=True,
+                              fanout=2)
+
+    if task == "learner":
+        model._base_model.v.assign(1.0)
+        model.push()
+        # Only the first level of the tree is pushed to directly
+        prefix = "workerInboundFromlearner"
+        sizes = [model._update_queues[f"{prefix}(0,{i})"].size()
+                 for i in range(2, 5)]
+        assert sizes == [0, 0, 0]
+    else:
+        # worker 4 is the only child of worker 1
+        if task_idx == 4:
+            assert model._pull_queues() == [
+                (1, "workerRelayFromlearner(1,4)")]
+        model.pull()
+        assert model(5.0) == 5.0
+    wait_for_shutdown(model)
+
+def test_routing_fn(args):
+    cluster_dict, task, task_idx, routing = args
+
+    clus = Cluster(cluster_dict, task, task_idx)
+    clus.start()
+
+    model = QueueModule({"x": [1]},
+                        cluster=clus,
+                        data_source="learner",
+                        module_name="worker",
+                        task=task,
+                        index=task_idx,
+                        routing=routing)
+
+    if task == "learner":
+        for i in range(4):
+            model.push({"x": [float(i)]})
+        queues = list(model._update_queues.values())
+        sizes = sorted(int(q.size()) for q in queues)
+        if routing == "hash":
+            assert sizes == [0, 4]
+        else:
+            assert sizes == [2, 2]
+        for q in queues:
+            q.dequeue_many(q.size())
+    wait_for_shutdown(model)
+
+def test_push_async_fn(args):
+    cluster_dict, task, task_idx = args
+
+    clus = Cluster(cluster_dict, task, task_idx)
+    clus.start()
+
+    model = QueueModule({"x": [1]},
+                        cluster=clus,
+                        data_source="learner",
+                        module_name="worker",
+                        task=task,
+                        index=task_idx,
+                        staging_capacity=2,
+                        staging_overflow="drop_oldest")
+
+    if task == "learner":
+        # Hold back the sender so the staging overflows. The same
+        # array is reused for every push, like a shared memory Env.
+        x = np.zeros(1)
+        with model._staging_cond:
+            for i in range(4):
+                x[0] = i
+                model.push_async({"x": x})
+        assert model.dropped == 2
+        model.flush()
+    else:
+        values = []
+        while len(values) < 2:
+            values.extend(model.pull_many(
+                10, return_data=True)["x"][:, 0].numpy().tolist())
+        assert values == [2., 3.]
+    wait_for_shutdown(model)
+
 class TestDistributedModel(unittest.TestCase):
 
     def test_push(self):
@@ -219,6 +448,76 @@ class TestDistributedModel(unittest.TestCase):
                                             'worker', 'learner', False)])
         print("Done")
 
+    def test_pull_many(self):
+        cluster_dict = {'worker': ['localhost:6006'],
+                        'learner': ['localhost:6007', 'localhost:6008']}
+        with multiprocessing.Pool(3) as pool:
+            pool.map(test_pull_many_fn, [(cluster_dict, 'learner', 0),
+                                         (cluster_dict, 'learner', 1),
+                                         (cluster_dict, 'worker', 0)])
+        print("Done")
+
+    def test_versioned(self):
+        cluster_dict = {'learner': ['localhost:6006'],
+                        'worker': ['localhost:6007', 'localhost:6008']}
+        for compile_push in [False, True]:
+            with multiprocessing.Pool(3) as pool:
+                pool.map(test_versioned_fn, [
+                    (cluster_dict, 'learner', 0, compile_push),
+                    (cluster_dict, 'worker', 0, compile_push),
+                    (cluster_dict, 'worker', 1, compile_push)])
+        print("Done")
+
+    def test_versioned_full(self):
+        cluster_dict = {'learner': ['localhost:6006'],
+                        'worker': ['localhost:6007', 'localhost:6008']}
+        for compile_push in [False, True]:
+            with multiprocessing.Pool(3) as pool:
+                pool.map(test_versioned_full_fn, [
+                    (cluster_dict, 'learner', 0, compile_push),
+                    (cluster_dict, 'worker', 0, compile_push),
+                    (cluster_dict, 'worker', 1, compile_push)])
+        print("Done")
+
+    def test_relay(self):
+        cluster_dict = {'learner': ['localhost:6006'],
+                        'worker': ['localhost:6007', 'localhost:6008',
+                                   'localhost:6009', 'localhost:6010',
+                                   'localhost:6011']}
+        with multiprocessing.Pool(6) as pool:
+            pool.map(test_relay_fn, [(cluster_dict, 'learner', 0)] + [
+                (cluster_dict, 'worker', i) for i in range(5)])
+        print("Done")
+
+    def test_routing(self):
+        cluster_dict = {'learner': ['localhost:6006'],
+                        'worker': ['localhost:6007', 'localhost:6008']}
+        for routing in ["round_robin", "least_loaded", "hash"]:
+            with multiprocessing.Pool(3) as pool:
+                pool.map(test_routing_fn,
+                         [(cluster_dict, 'learner', 0, routing),
+                          (cluster_dict, 'worker', 0, routing),
+                          (cluster_dict, 'worker', 1, routing)])
+        print("Done")
+
+    def test_push_async(self):
+        cluster_dict = {'learner': ['localhost:6006'],
+                        'worker': ['localhost:6007']}
+        with multiprocessing.Pool(2) as pool:
+            pool.map(test_push_async_fn, [(cluster_dict, 'learner', 0),
+                                          (cluster_dict, 'worker', 0)])
+        print("Done")
+
+    def test_update_codec(self):
+        cluster_dict = {'learner': ['localhost:6006'],
+                        'worker': ['localhost:6007']}
+        for codec in ["float16", "int8"]:
+            with multiprocessing.Pool(2) as pool:
+                pool.map(test_update_codec_fn,
+                         [(cluster_dict, 'learner', 0, codec),
+                          (cluster_dict, 'worker', 0, codec)])
+        print("Done")
+
 
 if __name__ == "__main__":
     unittest.main()
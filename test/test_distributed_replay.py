@@ -2,6 +2,8 @@ import unittest
 import tensorflow as tf
 import numpy as np
 import multiprocessing
+import os
+import tempfile
 
 import time
 from dtf.cluster import Cluster
@@ -39,9 +41,175 @@ def distributed_fn(args):
         model.push({"test": np.array([[1.]])})
         for k in model._update_queues:
             print(k, model._update_queues[k].size())
+        # The replay task keeps the learner queue topped up with
+        # prefetched batches so it never drains, wait for the learner
+        # to shut down instead.
+        try:
+            while True:
+                for k in model._update_queues:
+                    model._update_queues[k].size()
+                time.sleep(1)
+        except:
+            pass
+        return
     elif task == "learner":
         data = model.pull(return_data=True)
         print(data)
+        assert np.all(np.equal(data["test"].numpy(), 1.))
+        return
+    wait_for_shutdown(model)
+
+def two_replay_fn(args):
+    cluster_dict, task, task_idx, replay_buffer_type, kwargs = args
+
+    clus = Cluster(cluster_dict, task, task_idx)
+    clus.start()
+
+    model = DistributedRelayBuffer(
+        replay_buffer_type, {"test": (1,1)},
+        2, 2, "worker", "learner", "replay",
+        task, task_idx, clus, replay_buffer_kwargs=kwargs)
+
+    if kwargs:
+        # Only the replay tasks use the directory, each its own part
+        directory = model._base_model.directory
+        if task == "replay":
+            assert directory == os.path.join(
+                kwargs["directory"], f"replay-{task_idx}")
+        else:
+            assert not directory.startswith(kwargs["directory"])
+
+    if task == "replay":
+        try:
+            model.run()
+        except:
+            pass
+    elif task == "worker":
+        # Every replay task holds the value of its index
+        model.push({"test": np.array([[0.]])}, force_ind=0)
+        model.push({"test": np.array([[1.]])}, force_ind=1)
+        try:
+            while True:
+                for k in model._update_queues:
+                    model._update_queues[k].size()
+                time.sleep(1)
+        except:
+            pass
+        return
+    elif task == "learner":
+        # Both replay tasks keep their queue topped up, batches still
+        # have to come from both of them.
+        queues = [name for _, name in model._pull_queues()]
+        while any(model._update_queues[q].size() == 0 for q in queues):
+            time.sleep(0.01)
+        values = set()
+        for _ in range(4):
+            data = model.pull(return_data=True)
+            values.add(float(data["test"].numpy()[0, 0, 0]))
+        assert values == {0., 1.}
+        return
+    wait_for_shutdown(model)
+
+def prioritized_fn(args):
+    cluster_dict, task, task_idx = args
+
+    clus = Cluster(cluster_dict, task, task_idx)
+    clus.start()
+
+    model = DistributedRelayBuffer(
+        "prioritized", {"test": (1,1)},
+        2, 2, "worker", "learner", "replay",
+        task, task_idx, clus)
+
+    if task == "replay":
+        model.pull()
+        model.push(data=model._base_model.sample_n(2))
+        model._apply_priority_updates()
+        while model._base_model._tree.get(0) == 1.0:
+            model._apply_priority_updates()
+        assert np.isclose(model._base_model._tree.get(0),
+                          (5. + 1e-6) ** 0.6)
+    elif task == "worker":
+        model.push({"test": np.array([[1.]])})
+    elif task == "learner":
+        data = model.pull(return_data=True)
+        assert np.all(np.equal(data["indices"].numpy(), [0, 0]))
+        assert data["weights"].shape == (2,)
+        model.update_priorities(data["indices"], [5., 5.])
+    wait_for_shutdown(model)
+
+def chunked_fn(args):
+    cluster_dict, task, task_idx = args
+
+    clus = Cluster(cluster_dict, task, task_idx)
+    clus.start()
+
+    model = DistributedRelayBuffer(
+        "replay_buffer", {"test": (1,1)},
+        4, 2, "worker", "learner", "replay",
+        task, task_idx, clus,
+        inbound_size=2, max_queue_bytes=24)
+    # Every element holds 8 bytes
+    assert set(model._capacities.values()) == {3}
+
+    if task == "replay":
+        data = model.pull_many(4, return_data=True)
+        assert data["test"].shape == (2, 1, 1)
+        assert np.all(data["test"].numpy()[:, 0, 0] == [0., 1.])
+    elif task == "worker":
+        for i in range(3):
+            model.add({"test": np.array([[float(i)]])})
+        # The third transition waits for the next chunk
+        assert model._partial_chunk["test"].shape == (1, 1, 1)
+    wait_for_shutdown(model)
+
+def sharded_fn(args):
+    cluster_dict, task, task_idx = args
+    # The learner checks the share of micro-batches drawn per shard
+    np.random.seed(task_idx)
+
+    clus = Cluster(cluster_dict, task, task_idx)
+    clus.start()
+
+    model = DistributedRelayBuffer(
+        "replay_buffer", {"test": (1,1)},
+        4, 4, "worker", "learner", "replay",
+        task, task_idx, clus, shard_batches=2)
+
+    if task == "replay":
+        try:
+            model.run()
+        except:
+            pass
+    elif task == "worker":
+        # Three transitions on the first shard and one on the second
+        for i in range(3):
+            model.push({"test": np.array([[0.]])}, force_ind=0)
+        model.push({"test": np.array([[1.]])}, force_ind=1)
+        try:
+            while True:
+                for k in model._update_queues:
+                    model._update_queues[k].size()
+                time.sleep(1)
+        except:
+            pass
+        return
+    elif task == "learner":
+        fill = model._shard_fill()
+        while fill is None or not np.array_equal(fill, [[3., 3.], [1., 1.]]):
+            time.sleep(0.01)
+            fill = model._shard_fill()
+        shards = []
+        for _ in range(20):
+            data = model.pull(return_data=True)
+            assert data["test"].shape == (4, 1, 1)
+            # Every micro-batch holds the value stored on its shard
+            values = data["test"].numpy().reshape(2, 2)
+            assert np.all(values == model._last_shards[:, None])
+            shards.extend(model._last_shards)
+        # The second shard holds a quarter of the transitions
+        assert 0.1 < np.mean(shards) < 0.45
+        return
     wait_for_shutdown(model)
 
 class TestDistributedReplayBuffer(unittest.TestCase):
@@ -58,5 +226,51 @@ class TestDistributedReplayBuffer(unittest.TestCase):
             pool.map(distributed_fn, [(cluster_dict, 'learner', 0),
                                     (cluster_dict, 'worker', 0),
                                     (cluster_dict, 'replay', 0)])
+
+    def test_two_replay_tasks(self):
+        cluster_dict = {'learner': ['localhost:6006'],
+                        'worker': ['localhost:6007'],
+                        'replay': ['localhost:6008', 'localhost:6009']}
+        with tempfile.TemporaryDirectory() as directory:
+            for replay_buffer_type, kwargs in [
+                    ("replay_buffer", None),
+                    ("memmap", {"directory": directory})]:
+                with multiprocessing.Pool(4) as pool:
+                    pool.map(two_replay_fn, [
+                        (cluster_dict, task, task_idx,
+                         replay_buffer_type, kwargs)
+                        for task, task_idx in [('learner', 0),
+                                               ('worker', 0),
+                                               ('replay', 0),
+                                               ('replay', 1)]])
+
+    def test_distributed_prioritized_replay(self):
+        cluster_dict = {'learner': ['localhost:6006'],
+                        'worker': ['localhost:6007'],
+                        'replay': ['localhost:6008']}
+        with multiprocessing.Pool(3) as pool:
+            pool.map(prioritized_fn, [(cluster_dict, 'learner', 0),
+                                      (cluster_dict, 'worker', 0),
+                                      (cluster_dict, 'replay', 0)])
+
+    def test_chunked_replay(self):
+        cluster_dict = {'learner': ['localhost:6006'],
+                        'worker': ['localhost:6007'],
+                        'replay': ['localhost:6008']}
+        with multiprocessing.Pool(3) as pool:
+            pool.map(chunked_fn, [(cluster_dict, 'learner', 0),
+                                  (cluster_dict, 'worker', 0),
+                                  (cluster_dict, 'replay', 0)])
+
+    def test_sharded_replay(self):
+        cluster_dict = {'learner': ['localhost:6006'],
+                        'worker': ['localhost:6007'],
+                        'replay': ['localhost:6008', 'localhost:6009']}
+        with multiprocessing.Pool(4) as pool:
+            pool.map(sharded_fn, [(cluster_dict, 'learner', 0),
+                                  (cluster_dict, 'worker', 0),
+                                  (cluster_dict, 'replay', 0),
+                                  (cluster_dict, 'replay', 1)])
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,108 @@
+import unittest
+import tensorflow as tf
+import numpy as np
+
+from dtf.replay_buffer import FrameReplayBuffer, DistributedRelayBuffer
+
+physical_devices = tf.config.list_physical_devices('GPU')
+try:
+    for device in physical_devices:
+        tf.config.experimental.set_memory_growth(device, True)
+except:
+  # Invalid device or cannot modify virtual devices once initialized.
+  pass
+
+def make_step(obs, next_obs, done):
+    return {'observation': np.array(obs, dtype=np.float32)[:, None],
+            'next_observation': np.array(next_obs, dtype=np.float32)[:, None],
+            'done': np.array(done)}
+
+class TestFrameReplayBuffer(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+
+    def test_pairs(self):
+        spec = {'observation': [1], 'next_observation': [1],
+                'done': ((), tf.bool)}
+        replay_buffer = FrameReplayBuffer(spec, 8)
+        assert 'next_observation' not in replay_buffer.storage
+
+        # Two envs stepped together, env 1 finishes after its first step
+        replay_buffer.add(make_step([0., 10.], [1., 11.], [False, True]))
+        replay_buffer.add(make_step([1., 20.], [2., 21.], [False, False]))
+        # Nothing follows the last step of env 1 yet
+        replay_buffer.add(make_step([2., 21.], [3., 22.], [True, False]))
+
+        sample = replay_buffer.sample_n(200)
+        obs = sample['observation'].numpy()[:, 0]
+        next_obs = sample['next_observation'].numpy()[:, 0]
+        done = sample['done'].numpy()
+        assert set(obs) == {0., 1., 2., 10., 20.}
+        for o, n, d in zip(obs, next_obs, done):
+            if d:
+                assert n == o
+            else:
+                assert n == o + 1
+
+    def test_frame_stack(self):
+        spec = {'observation': [1], 'next_observation': [1],
+                'done': ((), tf.bool)}
+        replay_buffer = FrameReplayBuffer(spec, 8, frame_stack=3)
+        replay_buffer.add(make_step([0.], [1.], [False]))
+        replay_buffer.add(make_step([1.], [2.], [True]))
+        replay_buffer.add(make_step([5.], [6.], [False]))
+        replay_buffer.add(make_step([6.], [7.], [False]))
+
+        sample = replay_buffer.sample_n(100)
+        assert sample['observation'].shape == (100, 3, 1)
+        stacks = {tuple(o) for o in sample['observation'].numpy()[:, :, 0]}
+        # Stacks never reach back into the previous episode
+        assert stacks == {(0., 0., 0.), (0., 0., 1.), (5., 5., 5.)}
+        for o, n in zip(sample['observation'].numpy()[:, :, 0],
+                        sample['next_observation'].numpy()[:, :, 0]):
+            if tuple(o) == (0., 0., 0.):
+                assert tuple(n) == (0., 0., 1.)
+            if tuple(o) == (5., 5., 5.):
+                assert tuple(n) == (5., 5., 6.)
+
+    def test_eviction(self):
+        spec = {'observation': [1], 'next_observation': [1],
+                'done': ((), tf.bool)}
+        replay_buffer = FrameReplayBuffer(spec, 3, frame_stack=2)
+        for i in range(5):
+            replay_buffer.add(make_step([float(i)], [i + 1.], [False]))
+
+        # Slots hold 3, 4 and 2, the link from 4 is still pending
+        sample = replay_buffer.sample_n(100)
+        obs = sample['observation'].numpy()[:, :, 0]
+        next_obs = sample['next_observation'].numpy()[:, :, 0]
+        assert {tuple(o) for o in obs} == {(2., 2.), (2., 3.)}
+        for o, n in zip(obs, next_obs):
+            assert n[1] == o[1] + 1
+
+    def test_distributed_stream_key(self):
+        # In a distributed replay the rows of one add() come from many
+        # workers, so the row can not stand in for the stream.
+        spec = {"observation": (1,), "next_observation": (1,),
+                "done": (), "stream": ((), np.int64)}
+        with self.assertRaises(AssertionError):
+            DistributedRelayBuffer(
+                "frame", spec, 4, 2, "worker", "learner", "replay",
+                "learner", 0, None)
+
+        # Every transition of a stream has to reach the same replay
+        # task, without any dropped in between.
+        kwargs = {"stream_key": "stream"}
+        with self.assertRaises(AssertionError):
+            DistributedRelayBuffer(
+                "frame", spec, 4, 2, "worker", "learner", "replay",
+                "learner", 0, None, replay_buffer_kwargs=kwargs)
+        with self.assertRaises(AssertionError):
+            DistributedRelayBuffer(
+                "frame", spec, 4, 2, "worker", "learner", "replay",
+                "learner", 0, None, replay_buffer_kwargs=kwargs,
+                routing="hash", staging_capacity=8)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+import tensorflow as tf
+import numpy as np
+import multiprocessing
+
+from dtf.cluster import Cluster
+from dtf.modules import DistributedModel
+from dtf.inference import InferenceServer
+
+from test_utils import wait_for_shutdown
+
+physical_devices = tf.config.list_physical_devices('GPU')
+try:
+    for device in physical_devices:
+        tf.config.experimental.set_memory_growth(device, True)
+except:
+  # Invalid device or cannot modify virtual devices once initialized.
+  pass
+
+
+class DummyModel(DistributedModel):
+    def __init__(self):
+        super().__init__()
+        self.v = tf.Variable(0.0)
+
+    def __call__(self, x, explore=False):
+        return x["observation"][:, :2] * self.v
+
+def inference_fn(args):
+    cluster_dict, task, task_idx = args
+
+    clus = Cluster(cluster_dict, task, task_idx)
+    clus.start()
+
+    model = InferenceServer(
+        DummyModel(), (3,), (2,), 2, 4, 1.0,
+        "worker", "learner", "inference",
+        task, task_idx, clus)
+
+    if task == "inference":
+        model.pull()
+        model.serve()
+    elif task == "learner":
+        model._base_model.v.assign(2.0)
+        model.push()
+        # The learner runs its own copy of the model locally
+        action = model({"observation": np.ones((2, 3))})
+        assert np.all(action.numpy() == 2.0)
+    elif task == "worker":
+        obs = np.ones((2, 3)) * (task_idx + 1)
+        action = model({"observation": obs}, explore=True)
+        assert action.shape == (2, 2)
+        assert np.all(action.numpy() == 2.0 * (task_idx + 1))
+    wait_for_shutdown(model)
+
+class TestInferenceServer(unittest.TestCase):
+
+    def test_batched_inference(self):
+        cluster_dict = {'learner': ['localhost:6006'],
+                        'worker': ['localhost:6007', 'localhost:6008'],
+                        'inference': ['localhost:6009']}
+        with multiprocessing.Pool(4) as pool:
+            pool.map(inference_fn, [(cluster_dict, 'learner', 0),
+                                    (cluster_dict, 'worker', 0),
+                                    (cluster_dict, 'worker', 1),
+                                    (cluster_dict, 'inference', 0)])
+        print("Done")
+
+if __name__ == "__main__":
+    unittest.main()
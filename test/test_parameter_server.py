@@ -0,0 +1,71 @@
+import unittest
+import tensorflow as tf
+import numpy as np
+import multiprocessing
+
+from dtf.cluster import Cluster
+from dtf.modules import DistributedModel, ParameterServerModule
+
+physical_devices = tf.config.list_physical_devices('GPU')
+try:
+    for device in physical_devices:
+        tf.config.experimental.set_memory_growth(device, True)
+except:
+  # Invalid device or cannot modify virtual devices once initialized.
+  pass
+
+
+class DummyModel(DistributedModel):
+    def __init__(self):
+        super().__init__()
+        self.a = tf.Variable(tf.zeros([8]), name="a")
+        self.b = tf.Variable(tf.zeros([4]), name="b")
+        self.c = tf.Variable(tf.zeros([3]), name="c")
+
+def parameter_server_fn(args):
+    cluster_dict, task, task_idx, done = args
+
+    clus = Cluster(cluster_dict, task, task_idx)
+    clus.start()
+
+    model = ParameterServerModule(DummyModel(),
+                                  cluster=clus,
+                                  data_source="learner",
+                                  module_name="worker",
+                                  task=task,
+                                  index=task_idx)
+    # The largest variable gets a ps task to itself
+    assert model._shards == [[0], [1, 2]]
+
+    if task == "learner":
+        for v in model.variables:
+            v.assign(tf.ones_like(v))
+        model.push()
+        assert model.version == 1
+    elif task == "worker":
+        model.pull()
+        assert model.version == 1
+        for v in model.variables:
+            assert np.all(v.numpy() == 1.)
+    # Keep the shards alive until every worker has read them
+    done.wait(timeout=60)
+
+class TestParameterServer(unittest.TestCase):
+
+    def test_sharded_pull(self):
+        cluster_dict = {'learner': ['localhost:6006'],
+                        'worker': ['localhost:6007', 'localhost:6008'],
+                        'ps': ['localhost:6009', 'localhost:6010']}
+        with multiprocessing.Manager() as manager:
+            done = manager.Barrier(5)
+            with multiprocessing.Pool(5) as pool:
+                pool.map(parameter_server_fn,
+                         [(cluster_dict, 'learner', 0, done),
+                          (cluster_dict, 'worker', 0, done),
+                          (cluster_dict, 'worker', 1, done),
+                          (cluster_dict, 'ps', 0, done),
+                          (cluster_dict, 'ps', 1, done)])
+        print("Done")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+import tensorflow as tf
+import numpy as np
+
+import threading
+import time
+from dtf.learner.prefetcher import Prefetcher
+
+physical_devices = tf.config.list_physical_devices('GPU')
+try:
+    for device in physical_devices:
+        tf.config.experimental.set_memory_growth(device, True)
+except:
+  # Invalid device or cannot modify virtual devices once initialized.
+  pass
+
+class TestPrefetcher(unittest.TestCase):
+
+    def test_prefetch(self):
+        fetched = []
+        ready = threading.Event()
+
+        def fetch():
+            if len(fetched) == 5:
+                ready.set()
+                return None
+            fetched.append(len(fetched))
+            if len(fetched) == 2:
+                # Nothing available this time
+                return None
+            return {"test": tf.constant([float(len(fetched))])}, "origin"
+
+        prefetcher = Prefetcher(fetch, depth=2)
+        # Batches are pulled ahead without anyone asking for them
+        while len(fetched) < 3:
+            time.sleep(0.01)
+        for expected in [1., 3., 4., 5.]:
+            batch, origin = prefetcher.get()
+            assert np.all(np.equal(batch["test"].numpy(), [expected]))
+            assert origin == "origin"
+        ready.wait()
+        assert prefetcher.get(timeout=0.2) is None
+        prefetcher.close()
+
+    def test_error(self):
+        def fetch():
+            raise ValueError("replay went away")
+
+        prefetcher = Prefetcher(fetch)
+        with self.assertRaises(ValueError):
+            prefetcher.get()
+        prefetcher.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+import tensorflow as tf
+import numpy as np
+import tempfile
+
+from dtf.replay_buffer import PrioritizedReplayBuffer, get_replay_buffer
+from dtf.replay_buffer.sum_tree import SumTree
+
+physical_devices = tf.config.list_physical_devices('GPU')
+try:
+    for device in physical_devices:
+        tf.config.experimental.set_memory_growth(device, True)
+except:
+  # Invalid device or cannot modify virtual devices once initialized.
+  pass
+
+class TestPrioritizedReplayBuffer(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+
+    def test_sum_tree(self):
+        tree = SumTree(5)
+        tree.update([0, 1, 2, 3, 4], [1., 2., 3., 4., 0.])
+        assert tree.total == 10.
+
+        assert np.all(np.equal(
+            tree.find([0., 0.5, 1., 2.9, 3., 5.9, 6., 9.99]),
+            np.array([0, 0, 1, 1, 2, 2, 3, 3])
+        ))
+
+        # Batched updates with duplicate indices keep the last value
+        tree.update([1, 4, 1], [5., 1., 0.])
+        assert tree.total == 9.
+        assert np.all(np.equal(tree.get([0, 1, 4]), [1., 0., 1.]))
+
+    def test_get_replay_buffer(self):
+        assert get_replay_buffer("prioritized") is PrioritizedReplayBuffer
+
+    def test_prioritized_sampling(self):
+        replay_buffer = PrioritizedReplayBuffer(
+            {'test': [1]}, 4, alpha=1.0, beta=1.0)
+        assert replay_buffer.sample() is None
+
+        replay_buffer.add({'test': tf.constant([[0.], [1.], [2.], [3.]])})
+        sample = replay_buffer.sample_n(4)
+        assert sample['indices'].dtype == tf.int64
+        assert np.all(np.equal(sample['weights'].numpy(), 1.))
+
+        # Only slot 2 keeps a meaningful priority
+        replay_buffer.update_priorities([0, 1, 2, 3], [0., 0., 10., 0.])
+        sample = replay_buffer.sample_n(100)
+        counts = np.bincount(sample['indices'].numpy(), minlength=4)
+        assert counts[2] == 100
+        assert np.all(np.equal(sample['test'].numpy(), 2.))
+
+        # New transitions get the maximum priority seen so far
+        replay_buffer.add({'test': tf.constant([[4.]])})
+        sample = replay_buffer.sample_n(100)
+        counts = np.bincount(sample['indices'].numpy(), minlength=4)
+        assert counts[0] > 30 and counts[2] > 30
+
+    def test_snapshot_restore(self):
+        replay_buffer = PrioritizedReplayBuffer(
+            {'test': [1]}, 4, alpha=1.0, beta=1.0)
+        replay_buffer.add({'test': tf.constant([[0.], [1.], [2.]])})
+        replay_buffer.update_priorities([0, 1, 2], [0., 10., 0.])
+        with tempfile.TemporaryDirectory() as directory:
+            replay_buffer.snapshot(directory)
+            restored = PrioritizedReplayBuffer(
+                {'test': [1]}, 4, alpha=1.0, beta=1.0)
+            assert restored.restore(directory)
+        assert restored.sampling_mass == replay_buffer.sampling_mass
+        assert np.isclose(restored._max_priority, 10.)
+        sample = restored.sample_n(10)
+        assert np.all(np.equal(sample['test'].numpy(), 1.))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,8 +3,11 @@ import tensorflow as tf
 import numpy as np
 import multiprocessing
 
+import gc
+import os
+import tempfile
 import time
-from dtf.replay_buffer import ReplayBuffer
+from dtf.replay_buffer import ReplayBuffer, MemmapReplayBuffer
 
 physical_devices = tf.config.list_physical_devices('GPU')
 try:
@@ -55,5 +58,183 @@ class TestReplayBuffer(unittest.TestCase):
         ))
         print("done")
 
+    def test_fifo_eviction(self):
+        replay_buffer = ReplayBuffer({'test': [1]}, 3)
+        replay_buffer.add({'test': tf.constant([[1.], [2.]])})
+        assert replay_buffer.size == 2
+        assert isinstance(replay_buffer.storage['test'], tf.Variable)
+
+        # The oldest transitions are overwritten first
+        replay_buffer.add({'test': tf.constant([[3.], [4.]])})
+        assert replay_buffer.size == 3
+        assert np.all(np.equal(
+            replay_buffer.storage['test'].numpy(),
+            np.array([[4.], [2.], [3.]])
+        ))
+
+        # Only the newest capacity items of an oversized batch are kept
+        replay_buffer.add({'test': tf.constant(
+            [[5.], [6.], [7.], [8.], [9.]])})
+        assert np.all(np.equal(
+            replay_buffer.storage['test'].numpy(),
+            np.array([[7.], [8.], [9.]])
+        ))
+
+    def test_memmap_replay(self):
+        with tempfile.TemporaryDirectory() as directory:
+            replay_buffer = MemmapReplayBuffer(
+                {'test': [1, 1]}, 2, directory=directory)
+            assert replay_buffer.size == -1
+            assert replay_buffer.sample() is None
+
+            replay_buffer.add({'test': tf.constant([[1.]])})
+            sample = replay_buffer.sample()
+            assert np.all(np.equal(
+                sample['test'].numpy(),
+                np.array([[[1.]]])
+            ))
+
+            replay_buffer.add({'test': tf.constant([[3.]])})
+            replay_buffer.add({'test': tf.constant([[2.]])})
+            replay_buffer.flush()
+            del replay_buffer
+
+            # Reopening the directory restores the data and fill level
+            replay_buffer = MemmapReplayBuffer(
+                {'test': [1, 1]}, 2, directory=directory)
+            assert replay_buffer.size == 2
+            assert np.all(np.equal(
+                np.asarray(replay_buffer.storage['test']),
+                np.array([[[2.]], [[3.]]])
+            ))
+            replay_buffer.add({'test': tf.constant([[4.]])})
+            assert np.all(np.equal(
+                np.asarray(replay_buffer.storage['test']),
+                np.array([[[2.]], [[4.]]])
+            ))
+
+    def test_snapshot_restore(self):
+        with tempfile.TemporaryDirectory() as directory:
+            replay_buffer = ReplayBuffer({'test': [1]}, 4)
+            replay_buffer.add({'test': tf.constant([[1.], [2.]])})
+            # The first snapshot is a full one
+            replay_buffer.snapshot(directory, chunk_size=3)
+            assert len(os.listdir(directory)) == 4
+
+            # Then only the slots written since then
+            replay_buffer.add({'test': tf.constant([[3.]])})
+            replay_buffer.snapshot(directory, background=True).join()
+            assert len(os.listdir(directory)) == 5
+
+            restored = ReplayBuffer({'test': [1]}, 4)
+            assert restored.restore(directory)
+            assert restored.size == 3
+            assert np.all(np.equal(
+                restored.storage['test'].numpy()[:, 0], [1., 2., 3., 0.]))
+
+            # Once the increments add up to the capacity the next
+            # snapshot is a full one and the old files are dropped
+            restored.add({'test': tf.constant([[4.], [5.], [6.], [7.]])})
+            restored.snapshot(directory)
+            assert len(os.listdir(directory)) == 3
+            replay_buffer = MemmapReplayBuffer({'test': [1]}, 4)
+            assert replay_buffer.restore(directory)
+            assert replay_buffer.size == 4
+            assert np.all(np.equal(
+                np.asarray(replay_buffer.storage['test'])[:, 0],
+                [5., 6., 7., 4.]))
+
+            assert not ReplayBuffer({'test': [1]}, 4).restore(
+                os.path.join(directory, "missing"))
+
+    def test_snapshot_chunks(self):
+        class CountingLock:
+            def __init__(self):
+                self.count = 0
+            def __enter__(self):
+                self.count += 1
+            def __exit__(self, *args):
+                pass
+
+        with tempfile.TemporaryDirectory() as directory:
+            replay_buffer = MemmapReplayBuffer({'test': [1]}, 8)
+            replay_buffer.add({'test': np.arange(8.)[:, None]})
+            lock = CountingLock()
+            replay_buffer.snapshot(directory, chunk_size=3, lock=lock)
+            # Picking the slots with the state, then every chunk of the
+            # full snapshot are copied under the lock one by one
+            assert lock.count == 4
+
+            restored = ReplayBuffer({'test': [1]}, 8)
+            assert restored.restore(directory)
+            assert np.all(np.equal(
+                restored.storage['test'].numpy()[:, 0], np.arange(8.)))
+
+    def test_snapshot_concurrent_writes(self):
+        for replay_cls in [ReplayBuffer, MemmapReplayBuffer]:
+            with tempfile.TemporaryDirectory() as directory:
+                replay_buffer = replay_cls({'test': [1]}, 8)
+                replay_buffer.add({'test': tf.constant([[1.], [2.]])})
+
+                # Write to the buffer once the first chunk is copied, as
+                # the ingest thread would while a snapshot is written.
+                read_chunk = replay_buffer._snapshot_chunk
+                added = []
+                def read_and_add(idx):
+                    chunk = read_chunk(idx)
+                    if not added:
+                        added.append(True)
+                        replay_buffer.add({'test': tf.constant(
+                            [[3.], [4.], [5.], [6.], [7.], [8.], [9.]])})
+                    return chunk
+                replay_buffer._snapshot_chunk = read_and_add
+                replay_buffer.snapshot(directory, chunk_size=2)
+
+                # The snapshot holds the buffer from before the writes
+                restored = ReplayBuffer({'test': [1]}, 8)
+                assert restored.restore(directory)
+                assert restored.size == 2
+                assert restored._cursor == 2
+                assert np.all(np.equal(
+                    restored.storage['test'].numpy()[:, 0],
+                    [1., 2., 0., 0., 0., 0., 0., 0.]))
+
+                # and the written slots go into the next one
+                replay_buffer.snapshot(directory)
+                restored = ReplayBuffer({'test': [1]}, 8)
+                assert restored.restore(directory)
+                assert restored.size == 8
+                assert restored._cursor == 1
+                assert np.all(np.equal(
+                    restored.storage['test'].numpy()[:, 0],
+                    [9., 2., 3., 4., 5., 6., 7., 8.]))
+
+    def test_memmap_temporary_directory(self):
+        replay_buffer = MemmapReplayBuffer({'test': [1, 1]}, 2)
+        directory = replay_buffer.directory
+        assert os.path.exists(directory)
+        del replay_buffer
+        gc.collect()
+        assert not os.path.exists(directory)
+
+    def test_storage_dtypes(self):
+        spec = {'obs': ((2,), np.uint8),
+                'done': ((), tf.bool),
+                'reward': ((), 'float16'),
+                'value': [1]}
+        for replay_buffer in [ReplayBuffer(spec, 4),
+                              MemmapReplayBuffer(spec, 4)]:
+            replay_buffer.add({'obs': np.array([[1, 255]]),
+                               'done': np.array([True]),
+                               'reward': np.array([0.5]),
+                               'value': np.array([[2.]])})
+            sample = replay_buffer.sample()
+            assert sample['obs'].dtype == tf.uint8
+            assert sample['done'].dtype == tf.bool
+            assert sample['reward'].dtype == tf.float16
+            assert sample['value'].dtype == tf.float32
+            assert np.all(np.equal(sample['obs'].numpy(), [[1, 255]]))
+            assert np.all(sample['done'].numpy())
+
 if __name__ == "__main__":
     unittest.main()
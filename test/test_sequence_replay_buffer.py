@@ -0,0 +1,74 @@
+import unittest
+import tensorflow as tf
+import numpy as np
+
+from dtf.replay_buffer import SequenceReplayBuffer, get_replay_buffer
+
+physical_devices = tf.config.list_physical_devices('GPU')
+try:
+    for device in physical_devices:
+        tf.config.experimental.set_memory_growth(device, True)
+except:
+  # Invalid device or cannot modify virtual devices once initialized.
+  pass
+
+def make_step(obs, reward, done):
+    return {'observation': np.array(obs, dtype=np.float32)[:, None],
+            'next_observation': np.array(obs, dtype=np.float32)[:, None] + 1,
+            'reward': np.array(reward, dtype=np.float32),
+            'done': np.array(done)}
+
+SPEC = {'observation': [1], 'next_observation': [1], 'reward': [],
+        'done': ((), tf.bool)}
+
+class TestSequenceReplayBuffer(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+
+    def test_sequences(self):
+        replay_buffer = SequenceReplayBuffer(
+            SPEC, 20, sequence_length=3, num_streams=2)
+        assert get_replay_buffer('sequence') is SequenceReplayBuffer
+
+        # Env 0 ends an episode after 4 steps, env 1 keeps going
+        for t in range(8):
+            replay_buffer.add(make_step(
+                [t, 100 + t], [1., 1.], [t == 3, False]))
+
+        sample = replay_buffer.sample_n(200)
+        obs = sample['observation'].numpy()[:, :, 0]
+        assert obs.shape == (200, 3)
+        assert sample['reward'].shape == (200, 3)
+        # Consecutive steps of one env, never across an episode
+        assert np.all(np.diff(obs, axis=1) == 1.)
+        for seq in obs:
+            assert not (seq[0] <= 3 < seq[-1])
+
+    def test_nstep(self):
+        replay_buffer = SequenceReplayBuffer(
+            SPEC, 10, n_step=3, gamma=0.5)
+        for t, (r, d) in enumerate(
+                [(1., False), (2., False), (4., False), (8., True),
+                 (1., False)]):
+            replay_buffer.add(make_step([t], [r], [d]))
+
+        sample = replay_buffer.sample_n(100)
+        obs = sample['observation'].numpy()[:, 0, 0]
+        ret = sample['nstep_return'].numpy()[:, 0]
+        discount = sample['nstep_discount'].numpy()[:, 0]
+        bootstrap = sample['nstep_next_observation'].numpy()[:, 0, 0]
+        # The last step is still waiting for its next rewards
+        assert set(obs) == {0., 1., 2., 3.}
+        for o, r, d, b in zip(obs, ret, discount, bootstrap):
+            if o == 0.:
+                assert r == 1. + 0.5 * 2. + 0.25 * 4. and d == 0.125
+                assert b == 3.
+            elif o == 1.:
+                # The episode ends within the n steps
+                assert r == 2. + 0.5 * 4. + 0.25 * 8. and d == 0.
+            elif o == 3.:
+                assert r == 8. and d == 0.
+
+if __name__ == "__main__":
+    unittest.main()
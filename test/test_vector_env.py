@@ -0,0 +1,80 @@
+import unittest
+import numpy as np
+
+from unittest import mock
+from dtf.environment import Env
+
+class Space:
+    def __init__(self, shape, dtype):
+        self.shape = shape
+        self.dtype = dtype
+
+class FakeEnv:
+    """
+    Counts its steps, ends every episode after 3 of them and rewards
+    every step with the action.
+    """
+    def __init__(self, env_name, render_params=None):
+        self.render_params = render_params
+        self.observation_space = Space((2,), np.float64)
+        self.action_space = Space((), np.float32)
+        self._seed = 0
+        self._t = 0
+
+    def seed(self, seed):
+        self._seed = seed
+
+    def _obs(self):
+        return np.array([self._seed, self._t], dtype=np.float64)
+
+    def reset(self):
+        self._t = 0
+        return self._obs()
+
+    def step(self, action):
+        self._t += 1
+        return self._obs(), float(action), self._t == 3, {}
+
+    def close(self):
+        pass
+
+class TestVectorEnv(unittest.TestCase):
+
+    def _check(self, **kwargs):
+        env = Env("fake", 4, stream_offset=8, **kwargs)
+        try:
+            obs = env.reset()["observation"]
+            assert np.all(obs[:, 0] == [0., 100., 200., 300.])
+            assert np.all(obs[:, 1] == 0.)
+
+            for t in range(3):
+                data = env.step(np.arange(4, dtype=np.float32))
+                assert np.all(data["observation"][:, 1] == t)
+                assert np.all(data["next_observation"][:, 1] == t + 1)
+                assert np.all(data["reward"] == np.arange(4))
+                assert np.all(data["done"] == (t == 2))
+                assert np.all(data["stream"] == np.arange(8, 12))
+            # The first episode of every env returned 3 * its index
+            assert env.avg_return() == 4.5
+            assert env.max_step_reward() == 3.
+
+            # Envs run ahead of each other with step_async
+            env.step_async(np.ones(4, dtype=np.float32))
+            data = env.step_wait()
+            assert np.all(data["indices"] == np.arange(4))
+            assert np.all(data["observation"][:, 1] == 0.)
+        finally:
+            env.close()
+
+    def test_pipes(self):
+        with mock.patch("dtf.environment.gym_shm.make", FakeEnv):
+            self._check()
+            self._check(envs_per_process=2)
+
+    def test_shared_memory(self):
+        with mock.patch("dtf.environment.gym_shm.make", FakeEnv):
+            self._check(shared_memory=True)
+            self._check(shared_memory=True, envs_per_process=3)
+
+if __name__ == "__main__":
+    unittest.main()